@@ -0,0 +1,356 @@
+# cspell:ignore reconstructor, steganography, maxrss, rusage
+"""
+Benchmarks of the hot paths, on synthetic images.
+```
+python -m benchmarks.bench --sizes 256 1024 --output bench.json
+python -m benchmarks.bench --baseline old.json --threshold 0.2
+```
+Every case and every timed import runs in a fresh process, so its measures are its own. \
+Results are written as JSON, and comparing with a baseline exits with 1 when a case got slower \
+than the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from collections.abc import Callable
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from src import Generator, Reconstructor, Steganography
+from src.profiles import PROFILES, save
+
+SIZES = (256, 1024, 2048, 4096, 7680)
+QUICK_SIZES = (256, 1024)
+
+def synthetic_image(size: int, seed: int = 0) -> Image.Image:
+    """A noisy gradient, `size` wide in 16:9 past 4K (7680 is 8K UHD) and square below."""
+    height = size * 9 // 16 if size > 4096 else size
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 200, size, dtype=np.float32)[None, :, None]
+    noise = rng.integers(0, 56, (height, size, 3), dtype=np.uint8)
+    return Image.fromarray((gradient + noise).astype(np.uint8), "RGB")
+
+def _max_rss() -> int:
+    """Peak RSS of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+### ------------------------------ the cases ------------------------------------------
+# Each case prepares its inputs, then times only the operation. Returns (seconds, pixels), and
+# optionally a dict of extra measures.
+
+def _timed(fn: Callable) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def case_preview(path: str, intensity: float) -> tuple[float, int]:
+    generator = Generator(path, seed=0)
+    return _timed(lambda: generator.preview(intensity)), generator.img_data.size // 3
+
+def case_preview_many(path: str, number_preview: int) -> tuple[float, int]:
+    """`number_preview` intensities evenly up to 1, the pixels of every preview are counted."""
+    generator = Generator(path, seed=0)
+    intensities = [(i + 1) / number_preview for i in range(number_preview)]
+    return (_timed(lambda: generator.preview_many(intensities)),
+            generator.img_data.size // 3 * number_preview)
+
+def case_separate(path: str, number_layer: int) -> tuple[float, int]:
+    generator = Generator(path, seed=0)
+    return (_timed(lambda: generator.separate(number_layer, ignore_recommend=True)),
+            generator.img_data.size // 3 * number_layer)
+
+def case_clone(path: str, number_clone: int) -> tuple[float, int]:
+    generator = Generator(path, seed=0)
+    generator.separate(2)
+    return (_timed(lambda: generator.clone(number_clone)),
+            generator.img_data.size // 3 * number_clone)
+
+def case_clone_batched(path: str, number_clone: int) -> tuple[float, int]:
+    generator = Generator(path, seed=0)
+    generator.separate(2)
+    return (_timed(lambda: generator.clone_batched(number_clone)),
+            generator.img_data.size // 3 * number_clone)
+
+def _encode(cover: Image.Image, data: Image.Image, output: str):
+    """`Steganography.encode`, a failure is raised rather than timed as if it worked."""
+    assert Steganography.encode(cover, data, output), "Cannot encode the image within."
+
+def case_encode(path: str, cover_size: int) -> tuple[float, int]:
+    cover, data = synthetic_image(cover_size, 1), Image.open(path)
+    data.load()
+    output = os.path.join(tempfile.mkdtemp(), "encoded.png")
+    return _timed(lambda: _encode(cover, data, output)), cover.width * cover.height
+
+def case_decode(path: str, cover_size: int) -> tuple[float, int]:
+    cover, directory = synthetic_image(cover_size, 1), tempfile.mkdtemp()
+    _encode(cover, Image.open(path), os.path.join(directory, "encoded.png"))
+    encoded = Image.open(os.path.join(directory, "encoded.png"))
+    encoded.load()
+    output = os.path.join(directory, "decoded.png")
+    return _timed(lambda: Steganography.decode(encoded, output)), cover.width * cover.height
+
+def case_probe(path: str, cover_size: int) -> tuple[float, int]:
+    """From the encoded file, as the web service gets it."""
+    cover, directory = synthetic_image(cover_size, 1), tempfile.mkdtemp()
+    encoded = os.path.join(directory, "encoded.png")
+    _encode(cover, Image.open(path), encoded)
+    return _timed(lambda: Steganography.probe(encoded)), cover.width * cover.height
+
+def case_reconstruct(path: str, number_layer: int) -> tuple[float, int]:
+    layers = [np.asarray(layer) for layer in Generator(path, seed=0).separate(number_layer)]
+
+    def reconstruct():
+        reconstructor = Reconstructor()
+        for layer in layers:
+            reconstructor.add_layer(layer)
+        reconstructor.reconstruct()
+    return _timed(reconstruct), layers[0].size // 3 * number_layer
+
+def case_codec(path: str, profile: str) -> tuple[float, int, dict]:
+    """PNG of the whole image and WebP payload of it, both with `profile`."""
+    image = Image.open(path)
+    image.load()
+    png, webp = BytesIO(), BytesIO()
+    seconds = _timed(lambda: save(image, png, profile, "png"))
+    webp_seconds = _timed(lambda: save(image, webp, profile, "webp"))
+    return seconds, image.width * image.height, {
+        "png_bytes": png.tell(), "webp_seconds": webp_seconds, "webp_bytes": webp.tell()}
+
+CASES: dict[str, Callable[..., tuple]] = {
+    "preview": case_preview,
+    "preview_many": case_preview_many,
+    "separate": case_separate,
+    "clone": case_clone,
+    "clone_batched": case_clone_batched,
+    "encode": case_encode,
+    "decode": case_decode,
+    "probe": case_probe,
+    "reconstruct": case_reconstruct,
+    "codec": case_codec,
+}
+
+def plan(sizes: list[int]) -> list[tuple[str, str, int, float | int | str]]:
+    """Every (name, case, size, parameter) to run."""
+    cases = []
+    for size in sizes:
+        cases += [(f"preview/{size}/{i}", "preview", size, i) for i in (0.1, 0.5, 0.9)]
+        cases += [(f"preview_many/{size}/10", "preview_many", size, 10)]
+        cases += [(f"separate/{size}/{n}", "separate", size, n) for n in (2, 10, 50)]
+        cases += [(f"clone/{size}/4", "clone", size, 4)]
+        cases += [(f"clone_batched/{size}/4", "clone_batched", size, 4)]
+        cases += [(f"reconstruct/{size}/10", "reconstruct", size, 10)]
+        cases += [(f"codec/{size}/{profile}", "codec", size, profile) for profile in PROFILES]
+        # the hidden image is 256 px, only the cover grows.
+        if size > 256:
+            cases += [(f"encode/{size}", "encode", size, size), (f"decode/{size}", "decode", size,
+                                                                   size),
+                      (f"probe/{size}", "probe", size, size)]
+    return cases
+
+def _run_case(conn, case: str, path: str, parameter: float | int | str):
+    try:
+        rss_before = _max_rss()
+        seconds, pixels, *extra = CASES[case](path, parameter)
+        conn.send({"seconds": seconds, "pixels": pixels, "pixels_per_second": pixels / seconds,
+                   "peak_rss": _max_rss(), "rss_before": rss_before, **(extra[0] if extra else {})})
+    except Exception as e: # pylint: disable=broad-exception-caught
+        conn.send({"error": repr(e)})
+
+def _in_process(target: Callable, *args) -> dict:
+    """
+    `target(conn, *args)` in a fresh process, return what it sends on `conn`. A process which \
+    dies first (killed for its memory, say) gives an "error" with its exit code.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=target, args=(sender, *args))
+    process.start()
+    sender.close() # only the child holds it now, so its death ends `recv`.
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    return result or {"error": f"the process exited with code {process.exitcode}"}
+
+def run_case(case: str, path: str, parameter: float | int | str) -> dict:
+    """Run one case in a fresh process, return its measures."""
+    return _in_process(_run_case, case, path, parameter)
+
+### ------------------------------ import time ----------------------------------------
+
+# what library users, the CLI and the web service import, each timed in a fresh interpreter.
+IMPORTS = {
+    "package": "import src",
+    "generator": "from src import Generator",
+    "cli": "import src.cli",
+    "web": "from src.web import create_app",
+}
+# the ones which must not pull the web stack in, the run fails if they do.
+_WITHOUT_WEB = ("package", "generator", "cli")
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start, len(sys.modules), "fastapi" in sys.modules)
+"""
+
+def measure_import(statement: str, repeat: int = 5) -> dict:
+    """Fastest of `repeat` cold runs of `statement`, and whether it loaded FastAPI."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT.format(statement=statement)],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        seconds, modules, fastapi = output.stdout.split()
+        runs.append((float(seconds), int(modules), fastapi == "True"))
+    seconds, modules, fastapi = min(runs)
+    return {"seconds": seconds, "modules": modules, "loads_fastapi": fastapi}
+
+### ------------------------------ web load test --------------------------------------
+
+async def _load_test(concurrency: int, requests: int, size: int) -> dict:
+    """Upload then preview through the app, `concurrency` clients at once."""
+    import httpx # pylint: disable=import-outside-toplevel
+    from src.web import create_app # pylint: disable=import-outside-toplevel
+
+    buffer = BytesIO()
+    synthetic_image(size).save(buffer, format="png")
+    body = buffer.getvalue()
+    latencies: list[float] = []
+    failures = 0
+
+    async def client(client_id: int, session: httpx.AsyncClient):
+        nonlocal failures
+        for i in range(client_id, requests, concurrency):
+            start = time.perf_counter()
+            response = await session.post("/", data={"upload_type": "encode"},
+                                          files={"file": ("bench.png", body, "image/png")})
+            img = response.headers.get("location", "").rsplit("/", 1)[-1]
+            response = await session.post(f"/encode/{img}", data={
+                "selected": "panel_preview", "intensity": "0.5", "seed": str(i),
+                "save_path": f"bench-{i}.png"})
+            await session.post(f"/remove/{img}")
+            if response.status_code != 200 or f"bench-{i}.png" not in response.text:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    app = create_app()
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url="http://bench") as session:
+            await asyncio.gather(*(client(i, session) for i in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {"seconds": seconds, "requests": requests, "failures": failures,
+            "requests_per_second": requests / seconds,
+            "p50": latencies[len(latencies) // 2],
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "peak_rss": _max_rss()}
+
+def _run_load_test(conn, concurrency: int, requests: int, size: int):
+    conn.send(asyncio.run(_load_test(concurrency, requests, size)))
+
+def run_load_test(concurrency: int, requests: int, size: int) -> dict:
+    """Run the load test in a fresh process."""
+    return _in_process(_run_load_test, concurrency, requests, size)
+
+### ------------------------------ comparison -----------------------------------------
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Names of the cases more than `threshold` (0.2 = 20%) slower than in `baseline`."""
+    slower = []
+    for name, result in results["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if old and "seconds" in old and "seconds" in result:
+            if result["seconds"] > old["seconds"] * (1 + threshold):
+                slower.append(f"{name}: {old['seconds']:.4f}s -> {result['seconds']:.4f}s")
+    return slower
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the benchmarks, return the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(QUICK_SIZES),
+                        help=f"image widths to run, up to {SIZES[-1]} (8K). default: %(default)s")
+    parser.add_argument("--only", nargs="+", choices=[*CASES, "import"],
+                        help="run these cases only")
+    parser.add_argument("--load-test", type=int, nargs=2, metavar=("CONCURRENCY", "REQUESTS"),
+                        help="also run the web load test")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="JSON of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown that fails the comparison. default: %(default)s")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(), "machine": platform.machine(),
+               "cpus": os.cpu_count(), "time": time.time(), "cases": {}}
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for size in args.sizes:
+            paths[size] = os.path.join(directory, f"{size}.png")
+            synthetic_image(size).save(paths[size], compress_level=1)
+        # the image hidden by encode/decode/probe stays small.
+        hidden = os.path.join(directory, "hidden.png")
+        synthetic_image(256, 2).save(hidden)
+
+        for name, case, size, parameter in plan(args.sizes):
+            if args.only and case not in args.only:
+                continue
+            path = hidden if case in ("encode", "decode", "probe") else paths[size]
+            result = results["cases"][name] = run_case(case, path, parameter)
+            if "error" in result:
+                print(f"{name:<24} error {result['error']}")
+                failures.append(f"{name} failed: {result['error']}")
+            else:
+                print(f"{name:<24} {result['seconds']:>9.4f}s {result['pixels_per_second']:>14,.0f}"
+                      f" px/s {result['peak_rss'] / 1_048_576:>8.1f} MiB", end="")
+                if case == "codec":
+                    print(f"  png {result['png_bytes']:,} B, webp {result['webp_seconds']:.4f}s "
+                          f"{result['webp_bytes']:,} B", end="")
+                print()
+
+    if not args.only or "import" in args.only:
+        for name, statement in IMPORTS.items():
+            result = results["cases"][f"import/{name}"] = measure_import(statement)
+            print(f"{f'import/{name}':<24} {result['seconds']:>9.4f}s {result['modules']:>6} "
+                  f"modules{', loads fastapi' if result['loads_fastapi'] else ''}")
+            if name in _WITHOUT_WEB and result["loads_fastapi"]:
+                failures.append(f"import/{name} loads fastapi")
+
+    if args.load_test:
+        result = results["load_test"] = run_load_test(*args.load_test, QUICK_SIZES[-1])
+        if "error" in result:
+            print(f"{'load test':<24} error {result['error']}")
+            failures.append(f"load test failed: {result['error']}")
+        else:
+            print(f"{'load test':<24} {result['requests_per_second']:>9.2f} req/s p50 "
+                  f"{result['p50']:.3f}s p95 {result['p95']:.3f}s failures {result['failures']}")
+
+    if args.output:
+        with open(args.output, "wt", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "rt", encoding="utf-8") as f:
+            failures += regressions(results, json.load(f), args.threshold)
+    for line in failures:
+        print(f"REGRESSION {line}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,19 @@
 #cspell:ignore reconstructor, steganography
 
 """
-Initialization of the packages.
+Initialization of the packages. Names are imported on first use, so `from src import Generator` \
+does not load the web service.
 """
 
-from .generator import Generator
-from .reconstructor import Reconstructor
-from .steganography import Steganography
-from .web import app as FastAPIApp
+from importlib import import_module
+
+# name -> (module, attribute) it is imported from.
+_LAZY = {
+    "Generator": (".generator", "Generator"),
+    "Reconstructor": (".reconstructor", "Reconstructor"),
+    "Steganography": (".steganography", "Steganography"),
+    "FastAPIApp": (".web", "app"),
+}
 
 __all__ = [
     "Generator",
@@ -17,3 +23,15 @@ __all__ = [
 ]
 
 __version__ = '1.0.0'
+
+def __getattr__(name: str):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module, attribute = _LAZY[name]
+    value = getattr(import_module(module, __name__), attribute)
+    globals()[name] = value
+    return value
+
+def __dir__() -> list[str]:
+    # listed even before they are imported, `fastapi run src` looks for the app in here.
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,190 @@
+# cspell:ignore APNG, getppid, acTL, fcTL, fdAT
+"""
+Animated images, processed frame by frame on a process pool.
+```
+preview_animation("Path/to/animation.gif", 0.5, "preview.gif")
+```
+Frames are decoded as the pool takes them, only a window of them is in flight at once. An APNG \
+is written as they come back, GIF and WebP keep every frame until written (see `max_buffer`).
+"""
+
+import os
+import time
+import zlib
+import struct
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from .generator import Generator
+from .metrics import stage
+from .profiles import DEFAULT_PROFILE, Profile, save_options
+from .progress import report, silenced
+
+# processes of a frame pool when none is asked, it runs within a job worker already.
+DEFAULT_FRAME_WORKERS = min(4, os.cpu_count() or 1)
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def is_animated(img: Image.Image) -> bool:
+    """`img` has more than one frame."""
+    return getattr(img, "n_frames", 1) > 1
+
+def _watch_parent(parent: int):
+    """
+    Initializer of the pool processes, they exit once `parent` is gone. A cancelled job is \
+    terminated, its pool is not. The pool spawns its processes, so they are children of the \
+    one running the job even within a job worker itself started by a forkserver.
+    """
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(1)
+    threading.Thread(target=watch, daemon=True).start()
+
+def map_frames(fn: Callable[..., Image.Image], img: Image.Image, args: tuple = (),
+               seed: int | None = None, workers: int | None = None,
+               window: int | None = None) -> Iterator[Image.Image]:
+    """
+    `fn(frame, frame_seed, *args)` for every frame of `img`, in order. A frame is given as an \
+    RGB array, its duration is kept in the `info` of the result.
+
+    Args:
+        fn (Callable[..., Image.Image]): the work on one frame, top-level for the pool.
+        img (Image.Image): the animation.
+        args (tuple): the other arguments of `fn`.
+        seed (int | None): seed the seed of each frame is drawn from.
+        workers (int | None): processes, None for `DEFAULT_FRAME_WORKERS`. 1 works inline.
+        window (int | None): frames in flight at most, None for two per worker.
+
+    Returns:
+        Iterator[Image.Image]: the results.
+    """
+    workers = workers or DEFAULT_FRAME_WORKERS
+    window = window or 2 * workers
+    count = getattr(img, "n_frames", 1)
+    rng = np.random.default_rng(seed)
+
+    def frames():
+        for frame in ImageSequence.Iterator(img):
+            # APNG durations come as floats, the writers want milliseconds.
+            yield (np.asarray(frame.convert("RGB")), int(rng.integers(1 << 63)),
+                   int(round(frame.info.get("duration") or 0)))
+
+    def done(index: int, result: Image.Image, duration: int) -> Image.Image:
+        result.info["duration"] = duration
+        report("frames", (index + 1) / count)
+        return result
+
+    if workers <= 1:
+        for index, (frame, frame_seed, duration) in enumerate(frames()):
+            with silenced():
+                result = fn(frame, frame_seed, *args)
+            yield done(index, result, duration)
+        return
+
+    with ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"),
+                             initializer=_watch_parent, initargs=(os.getpid(),)) as pool:
+        pending = deque()
+        for index, (frame, frame_seed, duration) in enumerate(frames()):
+            pending.append((index, duration, pool.submit(fn, frame, frame_seed, *args)))
+            if len(pending) >= window:
+                index, duration, future = pending.popleft()
+                yield done(index, future.result(), duration)
+        while pending:
+            index, duration, future = pending.popleft()
+            yield done(index, future.result(), duration)
+
+def _preview_frame(frame: np.ndarray, seed: int, intensity: float, mode: str) -> Image.Image:
+    """
+    The preview of one frame, in `mode`. GIF stores "P", palettized here on the pool rather \
+    than frame by frame by the writer.
+    """
+    preview = Generator(frame, seed=seed).preview_many([intensity])[0] # a black frame is fine.
+    return preview if mode == "RGB" else preview.quantize(256, Image.Quantize.FASTOCTREE)
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def _png_chunks(data: bytes) -> Iterator[tuple[bytes, bytes]]:
+    """The `(kind, data)` of every chunk of the PNG file `data`."""
+    position = len(_PNG_SIGNATURE)
+    while position < len(data):
+        length, kind = struct.unpack_from(">I4s", data, position)
+        yield kind, data[position + 8:position + 8 + length]
+        position += 12 + length
+
+def _save_apng(frames: Iterator[Image.Image], count: int, loop: int, path: str,
+               profile: str | Profile):
+    """
+    Write the `count` RGB `frames` to `path` as an APNG, each one as soon as it comes: a frame \
+    is saved as a PNG alone, then its image data moves into the animation.
+    """
+    sequence = itertools.count()
+    with open(path, "wb") as file:
+        for index, frame in enumerate(frames):
+            buffered = BytesIO()
+            frame.save(buffered, **save_options("png", profile))
+            chunks = list(_png_chunks(buffered.getvalue()))
+            if index == 0:
+                file.write(_PNG_SIGNATURE)
+                file.write(_chunk(b"IHDR", dict(chunks)[b"IHDR"]))
+                file.write(_chunk(b"acTL", struct.pack(">II", count, loop)))
+            file.write(_chunk(b"fcTL", struct.pack(
+                ">IIIIIHHBB", next(sequence), frame.width, frame.height, 0, 0,
+                min(frame.info["duration"], 0xFFFF), 1000, 0, 0)))
+            for kind, data in chunks:
+                if kind != b"IDAT":
+                    continue
+                file.write(_chunk(b"IDAT", data) if index == 0 else
+                           _chunk(b"fdAT", struct.pack(">I", next(sequence)) + data))
+        file.write(_chunk(b"IEND", b""))
+
+def preview_animation(img: Image.Image, intensity: float, path: str, seed: int | None = None,
+                      workers: int | None = None, window: int | None = None,
+                      profile: str | Profile = DEFAULT_PROFILE, max_buffer: int = 1 << 30):
+    """
+    Save the preview of every frame of `img` as an animation in the format of `path` (a ".png" \
+    is an APNG), with the durations and loop count of `img`. An APNG is written frame by frame. \
+    The GIF and WebP writers of PIL keep every finished frame until the file is written, so \
+    those are refused when the frames would take more than `max_buffer` bytes.
+
+    Args:
+        img (Image.Image): the animation.
+        intensity (float): intensity of the preview (0-1).
+        path (str): where to save.
+        seed (int | None): seed of the previews.
+        workers (int | None): processes, None for `DEFAULT_FRAME_WORKERS`.
+        window (int | None): frames in flight at most, None for two per worker.
+        profile (str | Profile): codec profile of the saved file.
+        max_buffer (int): bytes of finished frames a GIF or WebP is allowed to keep.
+
+    Raises:
+        ValueError: the frames of a GIF or WebP would take more than `max_buffer`.
+    """
+    assert 0 <= intensity <= 1, "Invalid intensity"
+    image_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower(), "PNG")
+    mode = "P" if image_format == "GIF" else "RGB"
+    count = getattr(img, "n_frames", 1)
+    buffered = img.width * img.height * len(mode) * count
+    if image_format != "PNG" and buffered > max_buffer:
+        raise ValueError(f"The {count} frames take {buffered} bytes as {image_format}, more "
+                         f"than {max_buffer}. Save as PNG, written frame by frame.")
+
+    frames = map_frames(_preview_frame, img, (intensity, mode), seed, workers, window)
+    loop = img.info.get("loop", 0)
+    # the frames are generated while they are written, the stage covers both.
+    with stage("frames"):
+        if image_format == "PNG":
+            _save_apng(frames, count, loop, path, profile)
+            return
+        first = next(frames)
+        rest = list(frames) # the writers go through them more than once.
+        first.save(path, **save_options(image_format, profile), append_images=rest, save_all=True,
+                   loop=loop, duration=[frame.info["duration"] for frame in (first, *rest)])
@@ -0,0 +1,149 @@
+"""
+Remember finished results, so the same upload with the same options is not computed twice.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash the content of a file without loading it whole.
+
+    Args:
+        path (str): the file.
+        chunk_size (int): bytes read at once.
+
+    Returns:
+        str: the sha256 hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Disk-backed cache of result files, keyed by content. The least recently used entries are \
+    evicted once the cache is over `max_bytes`. Safe to use from several threads, and from \
+    several processes sharing `directory`: a miss looks for the entry on disk, and every store \
+    takes the size and order of the entries from the directory before evicting, a hit touching \
+    the file it copies.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict() # key -> size, oldest first.
+        self._size: int = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(operation: str, *parts: bytes | str | int | float | None) -> str:
+        """
+        Build the key of a result from the operation and everything it depends on.
+        ```
+        ResultCache.key("preview", input_hash, 0.5, None)
+        ```
+
+        Args:
+            operation (str): name of the operation.
+            parts (bytes | str | int | float | None): inputs and options, bytes are hashed.
+
+        Returns:
+            str: the key.
+        """
+        digest = hashlib.sha256(operation.encode())
+        for part in parts:
+            digest.update(b"\0")
+            digest.update(hashlib.sha256(part).digest() if isinstance(part, bytes)
+                          else repr(part).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _scan(self):
+        """Rebuild the entries from the directory, the other processes write and evict too."""
+        found = []
+        with os.scandir(self.directory) as scanned:
+            for item in scanned:
+                if item.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError: # evicted by another process.
+                    continue
+                found.append((stat.st_mtime_ns, item.name, stat.st_size))
+        with self._lock:
+            self._entries = OrderedDict((name, size) for _, name, size in sorted(found))
+            self._size = sum(self._entries.values())
+
+    def get(self, key: str, path: str) -> bool:
+        """
+        Copy the result of `key` to `path` if cached.
+
+        Args:
+            key (str): key from `ResultCache.key`.
+            path (str): where the result is wanted.
+
+        Returns:
+            bool: it was a hit.
+        """
+        try:
+            shutil.copyfile(self._path(key), path)
+            os.utime(self._path(key)) # the order of the entries for every process.
+        except FileNotFoundError: # never stored, or evicted by any process.
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+                self.misses += 1
+            return False
+        with self._lock:
+            if key not in self._entries: # stored by another process.
+                self._entries[key] = os.path.getsize(path)
+                self._size += self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return True
+
+    def put(self, key: str, path: str) -> None:
+        """
+        Store the file at `path` as the result of `key`.
+
+        Args:
+            key (str): key from `ResultCache.key`.
+            path (str): the result.
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+        # a name of its own, whichever thread of whichever process writes the same key.
+        descriptor, temporary = tempfile.mkstemp(".tmp", dir=self.directory)
+        os.close(descriptor)
+        try:
+            shutil.copyfile(path, temporary)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        self._scan() # with the entries of the other processes, so the limit holds for all.
+        with self._lock:
+            evicted = []
+            while self._size > self.max_bytes:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except FileNotFoundError: # evicted by another process as well.
+                pass
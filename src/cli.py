@@ -0,0 +1,272 @@
+# cspell:ignore reconstructor, steganography
+"""
+Batch processing of image directories from the command line.
+```
+quantum-pixel preview artworks/ -o previews/ --intensity 0.5 --workers 8 --resume
+quantum-pixel encode "artworks/*.png" -o encoded/ --disguise cover.png
+quantum-pixel separate artworks/ -o layers/ --layers 4
+quantum-pixel reconstruct layers/ -o rebuilt/
+```
+"""
+
+import os
+import re
+import sys
+import glob
+import argparse
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import (FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+from .generator import Generator
+from .profiles import DEFAULT_PROFILE, PROFILES, save
+from .reconstructor import Reconstructor
+from .steganography import Steganography
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+_LAYER = re.compile(r"^(?P<stem>.+)_layer_(?P<index>\d+)$")
+
+@dataclass
+class Task:
+    """
+    One unit of work.
+
+    Args:
+        name (str): shown in the output.
+        inputs (list[str]): files read.
+        outputs (list[str]): files written, in the order `compute` returns them.
+    """
+    name: str
+    inputs: list[str]
+    outputs: list[str]
+
+def expand(patterns: list[str]) -> list[str]:
+    """
+    Every image file of `patterns`, each one being a file, a directory or a glob.
+
+    Args:
+        patterns (list[str]): what the user typed.
+
+    Returns:
+        list[str]: sorted image paths.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            candidates = glob.glob(pattern) or [pattern]
+        paths.update(path for path in candidates
+                     if os.path.isfile(path) and path.lower().endswith(EXTENSIONS))
+    return sorted(paths)
+
+def _stem(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _names(inputs: list[str]) -> list[str]:
+    """
+    What the outputs of each input are named after: its stem, or its file name when other \
+    inputs share the stem (a.png and a.jpg give "a.png" and "a.jpg").
+    """
+    stems = Counter(map(_stem, inputs))
+    names = [_stem(path) if stems[_stem(path)] == 1 else os.path.basename(path) for path in inputs]
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    assert not duplicates, (f"Several inputs are named {', '.join(duplicates)}, their outputs "
+                            "would overwrite each other.")
+    return names
+
+### ------------------------------ compute stage --------------------------------------
+# Top-level, so the process pool can pickle them. Inputs are raw file bytes, decoded here on the
+# pool, outputs are images, PNG encoded by the write stage. Only reading and writing the files
+# stay in the I/O stages.
+
+def _preview(data: list[bytes], intensity: float, seed: int | None) -> list[Image.Image]:
+    return [Generator(data[0], seed=seed).preview(intensity)]
+
+def _separate(data: list[bytes], number_layer: int, seed: int | None) -> list[Image.Image]:
+    return Generator(data[0], seed=seed).separate(number_layer)
+
+def _encode(data: list[bytes], disguise: bytes, profile: str) -> list[Image.Image]:
+    return [Steganography.hide(Image.open(BytesIO(disguise)), Image.open(BytesIO(data[0])),
+                               profile=profile)]
+
+def _decode(data: list[bytes]) -> list[Image.Image]:
+    return [Steganography.reveal(Image.open(BytesIO(data[0])))]
+
+def _reconstruct(data: list[bytes]) -> list[Image.Image]:
+    reconstructor = Reconstructor()
+    for layer in data:
+        reconstructor.add_layer(Image.open(BytesIO(layer)))
+    return [reconstructor.reconstruct()]
+
+### ------------------------------ I/O stages -----------------------------------------
+
+def _read(paths: list[str]) -> list[bytes]:
+    result = []
+    for path in paths:
+        with open(path, "rb") as f:
+            result.append(f.read())
+    return result
+
+def _write(paths: list[str], images: list[Image.Image], profile: str):
+    # through a temporary file, so `--resume` never takes a half written file as done.
+    for path, image in zip(paths, images, strict=True):
+        save(image, f"{path}.tmp", profile, "png")
+        os.replace(f"{path}.tmp", path)
+
+def run_pipeline(tasks: list[Task], compute: Callable, args: tuple, workers: int,
+                 profile: str = DEFAULT_PROFILE) -> int:
+    """
+    Read, compute and write `tasks` as overlapping stages: reading and writing on threads, \
+    computing on a process pool of `workers` (inline threads when 1). At most two tasks per \
+    worker are read ahead, so memory stays bounded however many files there are.
+
+    Args:
+        tasks (list[Task]): the work.
+        compute (Callable): top-level `compute(data, *args) -> list[Image.Image]`.
+        args (tuple): extra arguments of `compute`.
+        workers (int): processes computing.
+        profile (str): codec profile of the written files.
+
+    Returns:
+        int: number of failed tasks.
+    """
+    window = 2 * workers
+    failed = 0
+    pending = iter(tasks)
+    reads: dict[Future, Task] = {}
+    computes: dict[Future, Task] = {}
+    writes: dict[Future, Task] = {}
+
+    def report(task: Task, future: Future) -> bool:
+        nonlocal failed
+        if future.exception() is None:
+            return True
+        failed += 1
+        print(f"{task.name}: failed, {future.exception()}", file=sys.stderr)
+        return False
+
+    pool: Executor = ProcessPoolExecutor(workers) if workers > 1 else ThreadPoolExecutor(1)
+    with ThreadPoolExecutor(workers + 2) as io, pool:
+        while True:
+            while len(reads) + len(computes) + len(writes) < window:
+                task = next(pending, None)
+                if task is None:
+                    break
+                reads[io.submit(_read, task.inputs)] = task
+            if not reads and not computes and not writes:
+                break
+
+            done, _ = wait([*reads, *computes, *writes], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in reads:
+                    task = reads.pop(future)
+                    if report(task, future):
+                        computes[pool.submit(compute, future.result(), *args)] = task
+                elif future in computes:
+                    task = computes.pop(future)
+                    if report(task, future):
+                        writes[io.submit(_write, task.outputs, future.result(), profile)] = task
+                else:
+                    task = writes.pop(future)
+                    if report(task, future):
+                        print(f"{task.name}: done")
+    return failed
+
+### ------------------------------ commands -------------------------------------------
+
+def _single_tasks(inputs: list[str], output: str) -> list[Task]:
+    return [Task(path, [path], [os.path.join(output, f"{name}.png")])
+            for path, name in zip(inputs, _names(inputs))]
+
+def _separate_tasks(inputs: list[str], output: str, number_layer: int) -> list[Task]:
+    return [Task(path, [path], [os.path.join(output, f"{name}_layer_{i}.png")
+                                for i in range(number_layer)])
+            for path, name in zip(inputs, _names(inputs))]
+
+def _reconstruct_tasks(inputs: list[str], output: str) -> list[Task]:
+    """Group `<stem>_layer_<i>` files by stem, as `separate` names them."""
+    groups: dict[str, list[tuple[int, str]]] = {}
+    for path in inputs:
+        match = _LAYER.match(_stem(path))
+        if match:
+            groups.setdefault(match["stem"], []).append((int(match["index"]), path))
+    return [Task(stem, [path for _, path in sorted(layers)], [os.path.join(output, f"{stem}.png")])
+            for stem, layers in sorted(groups.items())]
+
+def build_parser() -> argparse.ArgumentParser:
+    """The argument parser of `quantum-pixel`."""
+    parser = argparse.ArgumentParser(prog="quantum-pixel", description=(
+        "When both YES and NO are existed. Batch processing of images."))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def command(name: str, description: str) -> argparse.ArgumentParser:
+        sub = commands.add_parser(name, help=description, description=description)
+        sub.add_argument("inputs", nargs="+", help="image files, directories or globs")
+        sub.add_argument("-o", "--output", required=True, help="directory of the results")
+        sub.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                         help="processes computing at once. default: %(default)s")
+        sub.add_argument("--resume", action="store_true",
+                         help="skip inputs whose outputs already exist")
+        sub.add_argument("--profile", choices=list(PROFILES), default=DEFAULT_PROFILE,
+                         help="encoding speed against file size. default: %(default)s")
+        return sub
+
+    sub = command("preview", "Create the preview of every image.")
+    sub.add_argument("--intensity", type=float, required=True, help="from 0 to 1")
+    sub.add_argument("--seed", type=int, help="seed to reproduce a run")
+    sub = command("separate", "Separate every image into layers.")
+    sub.add_argument("--layers", type=int, required=True, help="layers per image")
+    sub.add_argument("--seed", type=int, help="seed to reproduce a run")
+    sub = command("encode", "Hide every image within the disguise image.")
+    sub.add_argument("--disguise", required=True, help="the disguise image")
+    command("decode", "Reveal what is hidden within every image.")
+    command("reconstruct", "Rebuild images from the layers `separate` wrote.")
+    return parser
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Entry of the `quantum-pixel` command.
+
+    Args:
+        argv (list[str] | None): arguments, None for `sys.argv`.
+
+    Returns:
+        int: exit code, 1 if any input failed.
+    """
+    args = build_parser().parse_args(argv)
+    inputs = expand(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+
+    match args.command:
+        case "preview":
+            assert 0 <= args.intensity <= 1, "Invalid intensity"
+            tasks, compute, extra = _single_tasks(inputs, args.output), _preview, (
+                args.intensity, args.seed)
+        case "separate":
+            tasks, compute, extra = _separate_tasks(inputs, args.output, args.layers), _separate, (
+                args.layers, args.seed)
+        case "encode":
+            with open(args.disguise, "rb") as f:
+                disguise = f.read()
+            tasks, compute, extra = _single_tasks(inputs, args.output), _encode, (disguise,
+                                                                                 args.profile)
+        case "decode":
+            tasks, compute, extra = _single_tasks(inputs, args.output), _decode, ()
+        case _:
+            tasks, compute, extra = _reconstruct_tasks(inputs, args.output), _reconstruct, ()
+
+    total = len(tasks)
+    if args.resume:
+        tasks = [task for task in tasks if not all(map(os.path.exists, task.outputs))]
+    failed = run_pipeline(tasks, compute, extra, max(1, args.workers), args.profile)
+    print(f"{total - len(tasks)} skipped, {len(tasks) - failed} done, {failed} failed.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
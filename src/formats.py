@@ -0,0 +1,30 @@
+"""
+Tell image formats apart from their first bytes, without decoding anything.
+"""
+
+# the first bytes of every accepted format, and the extension the upload is saved with.
+SIGNATURES: tuple[tuple[bytes, int, str], ...] = (
+    (b"\x89PNG\r\n\x1a\n", 0, ".png"),
+    (b"\xff\xd8\xff", 0, ".jpg"),
+    (b"GIF87a", 0, ".gif"),
+    (b"GIF89a", 0, ".gif"),
+    (b"WEBP", 8, ".webp"),
+    (b"BM", 0, ".bmp"),
+)
+SNIFF_BYTES = 12
+
+def sniff_format(head: bytes) -> str | None:
+    """
+    Find the image format from its first bytes.
+
+    Args:
+        head (bytes): at least `SNIFF_BYTES` bytes of the file.
+
+    Returns:
+        str | None: the extension of the format, None if not an accepted image.
+    """
+    for signature, offset, ext in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if ext != ".webp" or head.startswith(b"RIFF"):
+                return ext
+    return None
@@ -1,26 +1,245 @@
-# cspell:ignore setdiff, fromarray
+# cspell:ignore setdiff, fromarray, cumsum, searchsorted, memmap
 """
 Generating layers from an image file.
 """
 
+import os
 import logging
-from random import shuffle, randint
+import tempfile
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO
+from random import Random
+from typing import BinaryIO
 
 import numpy as np
 from PIL import Image
 
+from .metrics import stage
+from .progress import report
+
+ENGINES = ("numpy", "legacy")
+
+# pixels drawn per batch by the numpy engine. Big enough to amortize numpy calls, small enough to
+# not waste draws once the allowance ran out.
+_BLOCK_SIZE = 1 << 16
+
+def _draw_layer(image_data: np.ndarray, allowance: int, rng: np.random.Generator,
+                remove_interacted_data: bool, spend: Callable[[int], None] | None = None
+                ) -> np.ndarray:
+    """The numpy engine, spend `allowance` over random pixels of `image_data` into a new layer."""
+    layer: np.ndarray = np.zeros_like(image_data)
+
+    # flat views, so `remove_interacted_data` still edits `image_data` in place.
+    flat_data = image_data.reshape(-1, 3)
+    flat_layer = layer.reshape(-1, 3)
+    available_location = rng.permutation(flat_data.shape[0])
+
+    for start in range(0, available_location.size, _BLOCK_SIZE):
+        if allowance <= 0:
+            break
+        location = available_location[start:start + _BLOCK_SIZE]
+
+        # same as randint(0, value) for every channel of every pixel in the block.
+        values = rng.integers(0, flat_data[location].astype(np.uint16) + 1,
+                              dtype=np.uint16).reshape(-1)
+        spent = np.cumsum(values, dtype=np.int64)
+
+        if spent[-1] > allowance: # cut off where the allowance runs out.
+            cutoff = int(np.searchsorted(spent, allowance))
+            values[cutoff] -= spent[cutoff] - allowance
+            values[cutoff + 1:] = 0
+            location = location[:cutoff // 3 + 1]
+            values = values[:location.size * 3]
+            spent = spent[:cutoff + 1]
+
+        values = values.reshape(-1, 3).astype(np.uint8)
+        if remove_interacted_data:
+            flat_data[location] -= values
+        flat_layer[location] = values
+
+        amount = min(int(spent[-1]), allowance)
+        allowance -= amount
+        if spend is not None:
+            spend(amount)
+    return layer
+
+def _draw_layers(image_data: np.ndarray, allowance: int, count: int, rng: np.random.Generator,
+                 spend: Callable[[int], None] | None = None) -> np.ndarray:
+    """
+    `count` layers of the numpy engine at once, each spending `allowance` over its own random \
+    order of the pixels. Every block of the orders is drawn for all the layers still spending \
+    together. `image_data` is left as is.
+    """
+    flat_data = image_data.reshape(-1, 3)
+    pixels = flat_data.shape[0]
+    layers = np.zeros((count, pixels, 3), np.uint8)
+    orders = np.empty((count, pixels), np.int32 if pixels < 1 << 31 else np.int64)
+    for row in range(count):
+        orders[row] = rng.permutation(pixels)
+    remaining = np.full(count, allowance, np.int64)
+
+    for start in range(0, pixels, _BLOCK_SIZE):
+        rows = np.flatnonzero(remaining > 0)
+        if rows.size == 0:
+            break
+        location = orders[rows, start:start + _BLOCK_SIZE]
+
+        values = rng.integers(0, flat_data[location].astype(np.uint16) + 1,
+                              dtype=np.uint16).reshape(rows.size, -1)
+        spent = np.cumsum(values, axis=1, dtype=np.int64)
+        left = remaining[rows]
+        for row in np.flatnonzero(spent[:, -1] > left): # cut off where the allowance runs out.
+            cutoff = int(np.searchsorted(spent[row], left[row]))
+            values[row, cutoff] -= spent[row, cutoff] - left[row]
+            values[row, cutoff + 1:] = 0
+        amounts = np.minimum(spent[:, -1], left)
+
+        remaining[rows] -= amounts
+        layers[rows[:, None], location] = values.reshape(rows.size, -1, 3)
+        if spend is not None:
+            spend(int(amounts.sum()))
+    return layers.reshape(count, *image_data.shape)
+
+def _draw_sweep(image_data: np.ndarray, allowances: list[int], rng: np.random.Generator,
+                spend: Callable[[int], None] | None = None) -> np.ndarray:
+    """
+    A layer of the numpy engine for every allowance of `allowances`, from one random order and \
+    one set of draws. Each layer is the prefix of the draws within its allowance, so it is the \
+    layer `_draw_layer` makes from the same `rng` state. `image_data` is left as is.
+    """
+    limits = np.array(allowances, np.int64)
+    top = int(limits.max(initial=0))
+    flat_data = image_data.reshape(-1, 3)
+    pixels = flat_data.shape[0]
+    layer = np.zeros((pixels, 3), np.uint8) # the one of the highest allowance.
+    available_location = rng.permutation(pixels)
+    # where each allowance runs out: channel index in the drawing order, and what it takes there.
+    cutoffs = np.full(limits.size, pixels * 3, np.int64)
+    partials = np.zeros(limits.size, np.uint8)
+    total = 0 # spent before the block.
+
+    for start in range(0, pixels, _BLOCK_SIZE):
+        if total >= top:
+            break
+        location = available_location[start:start + _BLOCK_SIZE]
+        values = rng.integers(0, flat_data[location].astype(np.uint16) + 1,
+                              dtype=np.uint16).reshape(-1)
+        spent = total + np.cumsum(values, dtype=np.int64)
+
+        for row in np.flatnonzero((limits >= total) & (limits < spent[-1])):
+            cutoff = int(np.searchsorted(spent, limits[row]))
+            cutoffs[row] = start * 3 + cutoff
+            partials[row] = values[cutoff] - (spent[cutoff] - limits[row])
+        if spent[-1] > top:
+            values = np.minimum(values, np.clip(top - (spent - values), 0, None))
+        layer[location] = values.reshape(-1, 3)
+
+        if spend is not None:
+            spend(min(int(spent[-1]), top) - total)
+        total = int(spent[-1])
+
+    # a lower allowance keeps the pixels drawn before its cutoff, and part of the one at it.
+    rank = np.empty(pixels, np.int64)
+    rank[available_location] = np.arange(pixels)
+    layers = np.empty((limits.size, pixels, 3), np.uint8)
+    for row, (cutoff, partial) in enumerate(zip(cutoffs, partials)):
+        np.multiply(layer, (rank < cutoff // 3)[:, None], out=layers[row])
+        if cutoff < pixels * 3:
+            pixel, channel = available_location[cutoff // 3], cutoff % 3
+            layers[row, pixel, :channel] = layer[pixel, :channel]
+            layers[row, pixel, channel] = partial
+    return layers.reshape(limits.size, *image_data.shape)
+
+def _tile_layer(tile: np.ndarray, allowance: int, remove_interacted_data: bool,
+                seed: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generate one layer of one tile, top-level so the process pool can pickle it. Returns the \
+    layer and the tile, what remains of it when `remove_interacted_data` is set.
+    """
+    if allowance <= 0:
+        return np.zeros_like(tile), tile
+    return _draw_layer(tile, allowance, np.random.default_rng(seed), remove_interacted_data), tile
+
+# what `Generator` reads an image from.
+Source = str | os.PathLike | bytes | BinaryIO | Image.Image | np.ndarray
+
+def load_rgb(source: Source) -> np.ndarray:
+    """
+    The RGB pixels of `source` as a (height, width, 3) uint8 array. An RGB uint8 array is used \
+    as is (no copy), so is the buffer of an RGB image when numpy can share it.
+
+    Args:
+        source (Source): a path, encoded bytes, a file-like object, an image or an array.
+
+    Returns:
+        np.ndarray: the pixels, possibly read-only.
+    """
+    if isinstance(source, np.ndarray):
+        if source.dtype == np.uint8 and source.ndim == 3 and source.shape[2] == 3:
+            return np.ascontiguousarray(source)
+        source = Image.fromarray(source)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        source = Image.open(BytesIO(source))
+    elif not isinstance(source, Image.Image):
+        source = Image.open(source)
+    # convert to RGB to remove the only way AI can learn to solve.
+    return np.asarray(source if source.mode == "RGB" else source.convert("RGB"))
+
 class Generator:
     """
     The generator.
     """
-    def __init__(self, input_path: str):
-        try: # convert to RGB to remove the only way AI can learn to solve.
-            self.img_data = np.array(Image.open(input_path).convert("RGB"))
+    def __init__(self, source: Source, engine: str = "numpy", seed: int | None = None,
+                 tile_size: int | None = None, workers: int | None = 1,
+                 memmap_dir: str | None = None, pixel_sum: int | None = None):
+        """
+        Args:
+            source (Source): the image, a path, encoded bytes, a file-like object, a PIL \
+                image or an RGB array. Arrays and RGB images are not copied, and never \
+                modified.
+            engine (str): "numpy" for the batched engine, "legacy" for the per-pixel loop. Both \
+                spend the same allowance, kept side by side to compare output and speed.
+            seed (int | None): seed of the random source, set it to reproduce a run.
+            tile_size (int | None): process the image in tiles of `tile_size`x`tile_size` \
+                pixels, the allowance is split between tiles by their pixel sum. Working memory \
+                then depends on the tile, not the image. (numpy engine only)
+            workers (int | None): number of processes generating tiles, None for all cores.
+            memmap_dir (str | None): keep the layers and what remains of the image in \
+                memory-mapped files in this directory instead of RAM, when tiled. An image copies \
+                its layer to RAM, ask for arrays (`as_array`) to keep it on disk. (the files have \
+                no name, they are gone with the layers)
+            pixel_sum (int | None): sum of the pixels when already known (see `sources`), \
+                computed on first use otherwise.
+        """
+        assert engine in ENGINES, f"Invalid engine (should be one of {ENGINES})."
+        assert tile_size is None or (tile_size > 0 and engine == "numpy"), \
+            "Tiles need a positive size and the numpy engine."
+        try:
+            with stage("decode"):
+                self.img_data = load_rgb(source)
         except Exception as e:
             logging.error("Error opening image: %s", e)
             raise e
+        self.engine = engine
+        self.tile_size = tile_size
+        self.workers = workers or os.cpu_count() or 1
+        self.memmap_dir = memmap_dir
+        self._rng = np.random.default_rng(seed)
+        self._random = Random(seed)
         self._allowance: int = -1
         self._remain_allowance: int = -1
+        self._layer: tuple[int, int] = (0, 1) # index and count of the layers being generated.
+        self._pixel_sum = pixel_sum
+
+    @property
+    def pixel_sum(self) -> int:
+        """Sum of every channel of every pixel, what the allowances are taken from."""
+        if self._pixel_sum is None:
+            self._pixel_sum = int(np.sum(self.img_data))
+        return self._pixel_sum
 
     def receive_current_progress(self):
         """
@@ -28,15 +247,110 @@ class Generator:
         """
         return int(100*(1-self._remain_allowance/self._allowance))
 
-    def _generate(self, image_data: np.ndarray, remove_interacted_data: bool):
+    def _report(self):
+        index, count = self._layer
+        report("generate", (index + 1 - self._remain_allowance / self._allowance) / count)
+
+    def _generate(self, image_data: np.ndarray, remove_interacted_data: bool) -> np.ndarray:
         assert self._allowance > 0, "Allowance not set."
 
-        layer: np.ndarray = np.zeros_like(self.img_data)
+        with stage("generate"):
+            if self.engine == "legacy":
+                layer = self._generate_legacy(image_data, remove_interacted_data)
+            else:
+                layer = self._generate_numpy(image_data, remove_interacted_data)
+        return layer.astype(np.uint8, copy=False)
+
+    def _generate_numpy(self, image_data: np.ndarray, remove_interacted_data: bool) -> np.ndarray:
+        self._remain_allowance = self._allowance
+
+        def spend(amount: int):
+            self._remain_allowance -= amount
+            self._report()
+        return _draw_layer(image_data, self._allowance, self._rng, remove_interacted_data, spend)
+
+    def _allocate(self, shape: tuple[int, ...]) -> np.ndarray:
+        if self.memmap_dir is None:
+            return np.empty(shape, np.uint8)
+        # a file without a name, removed by the system once the array is freed.
+        with tempfile.TemporaryFile(dir=self.memmap_dir) as file:
+            return np.memmap(file, np.uint8, "w+", shape=shape)
+
+    def _iter_tiles(self) -> Iterator[tuple[slice, slice]]:
+        height, width = self.img_data.shape[:2]
+        for i in range(0, height, self.tile_size):
+            for j in range(0, width, self.tile_size):
+                yield slice(i, i + self.tile_size), slice(j, j + self.tile_size)
+
+    def _iter_tiled(self, number_layer: int, remove_interacted_data: bool
+                    ) -> Iterator[np.ndarray]:
+        """
+        Generate `number_layer` layers tile by tile, each tile gets its share of the allowance \
+        by pixel sum. A layer is yielded once all its tiles are done, before the next one is \
+        started, so only the image, what remains of it and one layer are held, the last two in \
+        files with `memmap_dir`. With several \
+        workers, tiles go to a process pool and only a couple of them per worker are in \
+        flight at once. When `remove_interacted_data` is set, the remaining is the last layer.
+        """
+        assert self._allowance > 0, "Allowance not set."
+
+        total = self.pixel_sum
+        tiles = list(self._iter_tiles())
+        allowances = [self._allowance * int(np.sum(self.img_data[tile_slice])) // total
+                      for tile_slice in tiles]
+        seeds = [int(seed) for seed in self._rng.integers(1 << 63, size=len(tiles))]
+        remaining = self.img_data
+        if remove_interacted_data:
+            remaining = self._allocate(self.img_data.shape)
+            remaining[:] = self.img_data
+        count = number_layer - remove_interacted_data
+
+        def jobs(index: int):
+            for tile_slice, allowance, seed in zip(tiles, allowances, seeds):
+                yield tile_slice, allowance, (remaining[tile_slice].copy(), allowance,
+                                              remove_interacted_data, (seed, index))
+
+        def done(layer: np.ndarray, tile_slice: tuple[slice, slice], allowance: int,
+                 result: tuple[np.ndarray, np.ndarray]):
+            layer[tile_slice], rest = result
+            if remove_interacted_data:
+                remaining[tile_slice] = rest
+            self._remain_allowance -= allowance
+            self._report()
+
+        with ExitStack() as stack:
+            pool = (stack.enter_context(ProcessPoolExecutor(self.workers))
+                    if self.workers > 1 else None)
+            for index in range(count):
+                layer = self._allocate(self.img_data.shape)
+                self._layer = (index, count)
+                self._remain_allowance = self._allowance
+                with stage("generate"):
+                    if pool is None:
+                        for tile_slice, allowance, args in jobs(index):
+                            done(layer, tile_slice, allowance, _tile_layer(*args))
+                    else:
+                        pending = deque()
+                        for tile_slice, allowance, args in jobs(index):
+                            pending.append((tile_slice, allowance,
+                                            pool.submit(_tile_layer, *args)))
+                            if len(pending) >= 2 * self.workers:
+                                tile_slice, allowance, future = pending.popleft()
+                                done(layer, tile_slice, allowance, future.result())
+                        while pending:
+                            tile_slice, allowance, future = pending.popleft()
+                            done(layer, tile_slice, allowance, future.result())
+                yield layer
+        if remove_interacted_data:
+            yield remaining
+
+    def _generate_legacy(self, image_data: np.ndarray, remove_interacted_data: bool) -> np.ndarray:
+        layer: np.ndarray = np.zeros_like(image_data)
 
         # [[i, j] for i in range(img_data.shape[0]) for j in range(img_data.shape[1])]
         available_location = np.stack(np.meshgrid(np.arange(self.img_data.shape[0]),
             np.arange(self.img_data.shape[1])), axis=-1).reshape(-1, 2).tolist()
-        shuffle(available_location)
+        self._random.shuffle(available_location)
 
         # do the shit.
         self._remain_allowance = self._allowance
@@ -46,13 +360,18 @@ class Generator:
                 location = tuple(available_location.pop())
             except IndexError:
                 break
+            if len(available_location) % 4096 == 0:
+                self._report()
             for current_value in range(3): # RGBA channels
-                value = min(randint(0, image_data[location][current_value]), self._remain_allowance)
+                # a python int, randint and the arithmetic below overflow on numpy uint8.
+                value = min(self._random.randint(0, int(image_data[location][current_value])),
+                            self._remain_allowance)
                 if remove_interacted_data:
-                    image_data[location][current_value] -= value
+                    image_data[location][current_value] = \
+                        int(image_data[location][current_value]) - value
                 layer[location][current_value] = value
                 self._remain_allowance -= value
-        return Image.fromarray(layer.astype(np.uint8), "RGB")
+        return layer
 
     def preview(self, intensity: float) -> Image.Image:
         """
@@ -74,8 +393,42 @@ class Generator:
         """
         assert 0 <= intensity <= 1, "Invalid intensity"
 
-        self._allowance = int(int(np.sum(self.img_data) * intensity))
-        return self._generate(self.img_data, False)
+        self._allowance = int(self.pixel_sum * intensity)
+        self._layer = (0, 1)
+        if self.tile_size:
+            return Image.fromarray(next(self._iter_tiled(1, False)), "RGB")
+        return Image.fromarray(self._generate(self.img_data, False), "RGB")
+
+    def preview_many(self, intensities: list[float]) -> list[Image.Image]:
+        """
+        Generate the preview of every intensity at once, for a slider. The numpy engine shuffles \
+        and draws once for the highest intensity, the others are cut off from the same draws, \
+        so N previews cost about one. Each is the preview `preview` makes from the same seed.
+        ```
+        generator = Generator("Path/to/image.png", seed=0)
+        low, high = generator.preview_many([0.2, 0.8])
+        ```
+
+        Args:
+            intensities (list[float]): the intensities (0-1), in any order.
+
+        Returns:
+            list[Image.Image]: the previews, in the order of `intensities`.
+        """
+        assert all(0 <= intensity <= 1 for intensity in intensities), "Invalid intensity"
+        if self.engine == "legacy" or self.tile_size:
+            return [self.preview(intensity) for intensity in intensities]
+
+        allowances = [int(self.pixel_sum * intensity) for intensity in intensities]
+        self._allowance = self._remain_allowance = max(allowances, default=0)
+        self._layer = (0, 1)
+
+        def spend(amount: int):
+            self._remain_allowance -= amount
+            self._report()
+        with stage("generate"):
+            layers = _draw_sweep(self.img_data, allowances, self._rng, spend)
+        return [Image.fromarray(layer, "RGB") for layer in layers]
 
     def separate(self, number_layer: int, ignore_recommend: bool = False) -> list[Image.Image]:
         """
@@ -97,6 +450,29 @@ class Generator:
         Returns:
             list[Image.Image]: List of generated layers.
         """
+        return list(self.iter_separate(number_layer, ignore_recommend))
+
+    def iter_separate(self, number_layer: int, ignore_recommend: bool = False,
+                      as_array: bool = False) -> Iterator[Image.Image] | Iterator[np.ndarray]:
+        """
+        Same as `separate`, but each layer is yielded as soon as it is generated, so it can be \
+        saved and freed before the next one.
+        ```
+        for i, img in enumerate(generator.iter_separate(50)):
+            img.save(f"layer_{i}.png")
+        ```
+
+
+        Args:
+            number_layer (int): number of layers to generate. (recommend 1-100)
+            ignore_recommend (bool): see `separate`.
+            as_array (bool): yield RGB arrays instead of images, memory-mapped with \
+                `memmap_dir` and tiles, so a layer is not copied to RAM.
+
+
+        Returns:
+            Iterator[Image.Image] | Iterator[np.ndarray]: the layers, in order.
+        """
 
         assert number_layer > 1, "Should be greater than 1."
         assert number_layer < self.img_data.shape[0] * self.img_data.shape[1], f"Too many layers \
@@ -106,15 +482,19 @@ class Generator:
                 to True to bypass this check."
 
         # set the allowance. (yes)
-        self._allowance = int(np.sum(self.img_data) / number_layer)
+        self._allowance = int(self.pixel_sum / number_layer)
 
-        # generating layers.
-        result = []
+        # generating layers, checked above and not at the first `next`.
+        layers = (self._iter_tiled(number_layer, True) if self.tile_size else
+                  self._iter_separate(number_layer))
+        return layers if as_array else (Image.fromarray(layer, "RGB") for layer in layers)
+
+    def _iter_separate(self, number_layer: int) -> Iterator[np.ndarray]:
         remaining: np.ndarray = self.img_data.copy()
-        for _ in range(number_layer - 1):
-            result.append(self._generate(remaining, True))
-        result.append(Image.fromarray(remaining.astype(np.uint8), "RGB"))
-        return result
+        for i in range(number_layer - 1):
+            self._layer = (i, number_layer - 1)
+            yield self._generate(remaining, True)
+        yield remaining.astype(np.uint8, copy=False)
 
     def clone(self, number_clone: int) -> list[Image.Image]:
         """
@@ -136,14 +516,66 @@ class Generator:
         Returns:
             list[Image.Image]: List of generated clones.
         """
+        return list(self.iter_clone(number_clone))
+
+    def clone_batched(self, number_clone: int) -> np.ndarray:
+        """
+        Same as `clone`, but every clone is drawn at once with array operations, into one array. \
+        It holds all the clones and the random order of the pixels of each, about 7 bytes per \
+        pixel per clone (3 for the clone, 4 for its order, 8 past 2**31 pixels), so keep \
+        `number_clone` in check on large images. (numpy engine without tiles only)
+        ```
+        clones = generator.clone_batched(4)
+        Image.fromarray(clones[0]).show()
+        ```
+
+
+        Args:
+            number_clone (int): number of clones to generate.
+
+
+        Returns:
+            np.ndarray: the clones, shaped (`number_clone`, height, width, 3).
+        """
+        assert self.engine == "numpy" and not self.tile_size, \
+            "Batched clones need the numpy engine without tiles."
+        assert self._allowance != -1, "Separate layers first before clone actually."
+        total = self._allowance * number_clone
+        spent = 0
+
+        def spend(amount: int):
+            nonlocal spent
+            spent += amount
+            report("generate", spent / total)
+        with stage("generate"):
+            return _draw_layers(self.img_data, self._allowance, number_clone, self._rng, spend)
+
+    def iter_clone(self, number_clone: int, as_array: bool = False
+                   ) -> Iterator[Image.Image] | Iterator[np.ndarray]:
+        """
+        Same as `clone`, but each clone is yielded as soon as it is generated.
+
+
+        Args:
+            number_clone (int): number of clones to generate.
+            as_array (bool): yield RGB arrays instead of images, see `iter_separate`.
+
+
+        Returns:
+            Iterator[Image.Image] | Iterator[np.ndarray]: the clones.
+        """
 
         assert self._allowance != -1, "Separate layers first before clone actually."
 
         # generating clones.
-        result = []
-        for _ in range(number_clone):
-            result.append(self._generate(self.img_data, False))
-        return result
+        layers = (self._iter_tiled(number_clone, False) if self.tile_size else
+                  self._iter_clone(number_clone))
+        return layers if as_array else (Image.fromarray(layer, "RGB") for layer in layers)
+
+    def _iter_clone(self, number_clone: int) -> Iterator[np.ndarray]:
+        for i in range(number_clone):
+            self._layer = (i, number_clone)
+            yield self._generate(self.img_data, False)
 
 if __name__ == "__main__":
     generator = Generator("material.png")
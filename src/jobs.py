@@ -0,0 +1,470 @@
+# cspell:ignore stegano
+"""
+Run the heavy work of the web service away from the event loop.
+"""
+
+import os
+import time
+import asyncio
+import weakref
+import threading
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any
+
+from PIL import Image
+
+from .animation import is_animated, preview_animation
+from .generator import Generator
+from .metrics import METRICS, collect, record, record_all
+from .progress import Callback, reporting
+from .profiles import DEFAULT_PROFILE, save
+from .scheduler import Scheduler
+from .sources import SOURCES
+from .steganography import Steganography
+
+BACKENDS = ("process", "thread")
+# uploads a worker process is remembered for, to send their jobs its way.
+_WORKER_SOURCES = 16
+# seconds between two looks of an idle worker process for removed uploads.
+_PRUNE_INTERVAL = 60
+
+class QueueFullError(Exception):
+    """Every worker is busy and the waiting queue is full."""
+
+class BudgetExceededError(QueueFullError):
+    """The estimated cost of the outstanding jobs would go over the budget."""
+
+### ------------------------------ the jobs -------------------------------------------
+# Top-level, so they can be sent to another process. They read and write files themselves
+# and only return small values, nothing large crosses the process boundary. Uploads are decoded
+# through `SOURCES`, kept by the process which ran the job for the next ones.
+
+def preview_job(input_path: str, intensity: float, output_path: str, seed: int | None = None,
+                profile: str = DEFAULT_PROFILE, frame_workers: int | None = None) -> bool:
+    """Save the preview of `input_path`, of every frame on `frame_workers` processes if animated."""
+    img = Image.open(input_path)
+    if is_animated(img):
+        preview_animation(img, intensity, output_path, seed, frame_workers, profile=profile)
+        return True
+    decoded = SOURCES.get(input_path)
+    save(Generator(decoded.pixels, seed=seed, pixel_sum=decoded.pixel_sum).preview(intensity),
+         output_path, profile)
+    return True
+
+def preview_many_job(input_path: str, intensities: list[float], output_paths: list[str],
+                     seed: int | None = None, profile: str = DEFAULT_PROFILE) -> bool:
+    """Save the preview of `input_path` at every intensity, from one set of draws."""
+    decoded = SOURCES.get(input_path)
+    generator = Generator(decoded.pixels, seed=seed, pixel_sum=decoded.pixel_sum)
+    for preview, output_path in zip(generator.preview_many(intensities), output_paths):
+        save(preview, output_path, profile)
+    return True
+
+def encode_job(disguise: bytes, input_path: str, output_path: str,
+               profile: str = DEFAULT_PROFILE) -> bool:
+    """Hide `input_path` within the `disguise` image, shrunk if needed to fit in one pass."""
+    decoded = SOURCES.get(input_path)
+    # the decoded pixels lost any alpha or palette, such an image is read again.
+    data = (Image.fromarray(decoded.pixels, "RGB") if decoded.mode == "RGB"
+            else Image.open(input_path))
+    return Steganography.encode(Image.open(BytesIO(disguise)), data, output_path, fit=True,
+                                profile=profile)
+
+def preview_encode_job(input_path: str, intensity: float, output_path: str,
+                       seed: int | None = None, profile: str = DEFAULT_PROFILE) -> bool:
+    """Save the preview of `input_path` with `input_path` hidden within, decoding it once."""
+    decoded = SOURCES.get(input_path)
+    return Steganography.encode_preview(decoded.pixels, intensity, output_path, seed,
+                                        profile=profile, pixel_sum=decoded.pixel_sum)
+
+def decode_job(input_path: str, output_path: str, profile: str = DEFAULT_PROFILE) -> bool:
+    """Reveal what is hidden within `input_path`."""
+    return Steganography.decode(Image.open(input_path), output_path, profile)
+
+### ------------------------------ the executors --------------------------------------
+
+_REJECTED = METRICS.counter("qp_jobs_rejected_total",
+                            "Jobs refused, by reason: the queue is full or the cost budget.")
+_COSTS = METRICS.histogram("qp_job_cost_seconds", "Estimated seconds of one core of each job.")
+
+@dataclass
+class Admission:
+    """The place and cost of one job taken by `JobExecutor.admit`, until `JobExecutor.release`."""
+    cost: float = 0.0
+    released: bool = False
+
+class JobExecutor(ABC):
+    """
+    Run jobs with at most `workers` at once and `max_queue` waiting, anything beyond raises \
+    `QueueFullError`. A `max_cost` budget also refuses a job once the estimated cost of the \
+    outstanding ones would go over it. Waiting jobs get a worker in the order of `Scheduler`. \
+    The processes running jobs keep `source_cache_bytes` of decoded uploads between them, None \
+    leaves the size of `SOURCES` as is.
+    """
+    def __init__(self, workers: int | None = None, max_queue: int = 16, max_cost: float = 0.0,
+                 max_delay: float = 30.0, source_cache_bytes: int | None = None):
+        self.workers: int = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.max_cost = max_cost
+        self.source_cache_bytes = source_cache_bytes
+        self._outstanding: int = 0
+        self._outstanding_cost: float = 0.0
+        self._running: int = 0
+        self._scheduler = Scheduler(self.workers, max_delay)
+
+    @property
+    def outstanding(self) -> int:
+        """Jobs running or waiting."""
+        return self._outstanding
+
+    @property
+    def outstanding_cost(self) -> float:
+        """Estimated cost of the jobs running or waiting."""
+        return self._outstanding_cost
+
+    @property
+    def running(self) -> int:
+        """Jobs running."""
+        return self._running
+
+    @property
+    def full(self) -> bool:
+        """Another job would raise `QueueFullError`."""
+        return self._outstanding >= self.workers + self.max_queue
+
+    def admit(self, cost: float = 0.0) -> Admission:
+        """
+        Take the place and the `cost` of a job right away, so the jobs admitted before any of \
+        them runs are counted. A job over the whole budget is still admitted when nothing else is \
+        outstanding.
+
+        Raises:
+            QueueFullError: no room for another job.
+            BudgetExceededError: no room for that much work.
+
+        Returns:
+            Admission: the place, to give to `run` and `release` in any case.
+        """
+        if self.full:
+            _REJECTED.inc(reason="queue")
+            raise QueueFullError("Too many jobs.")
+        if self.max_cost and self._outstanding and self._outstanding_cost + cost > self.max_cost:
+            _REJECTED.inc(reason="cost")
+            raise BudgetExceededError("Too much work.")
+        self._outstanding += 1
+        self._outstanding_cost += cost
+        _COSTS.observe(cost)
+        return Admission(cost)
+
+    def release(self, admission: Admission):
+        """Give back the place and cost of `admission`, only the first call counts."""
+        if not admission.released:
+            admission.released = True
+            self._outstanding -= 1
+            self._outstanding_cost -= admission.cost
+
+    async def run(self, uid: str, fn: Callable, *args, on_progress: Callback | None = None,
+                  cost: float = 0.0, client: str = "", source: str | None = None,
+                  admission: Admission | None = None) -> Any:
+        """
+        Run `fn(*args)` as the job `uid` and wait for its result. The stages the job timed, \
+        and its wait for a worker, are recorded where it was awaited (see `metrics.collect`).
+
+        Args:
+            uid (str): id used to cancel the job.
+            fn (Callable): the job, top-level for the process backend.
+            on_progress (Callback | None): called on the event loop with what the job \
+                reports (see `progress.report`).
+            cost (float): estimated cost of the job, see `scheduler.estimate_cost`, the one of \
+                `admission` when given.
+            client (str): who asked for it, clients take turns for the workers.
+            source (str | None): the upload the job decodes through `SOURCES`, the jobs of an \
+                upload go to the worker which decoded it when it is free.
+            admission (Admission | None): the place taken by `admit` beforehand, None to take \
+                it here. Released once the job is over.
+
+        Raises:
+            QueueFullError: no room for another job.
+            BudgetExceededError: no room for that much work.
+            asyncio.CancelledError: the job got cancelled.
+
+        Returns:
+            Any: what `fn` returned.
+        """
+        if admission is None:
+            admission = self.admit(cost)
+        cost = admission.cost
+        queued_at = time.perf_counter()
+        try:
+            await self._scheduler.acquire(uid, cost, client)
+            try:
+                record("queue_wait", time.perf_counter() - queued_at)
+                return await self._run(uid, fn, args, on_progress, source)
+            finally:
+                self._scheduler.release(uid)
+        finally:
+            self.release(admission)
+
+    @abstractmethod
+    async def _run(self, uid: str, fn: Callable, args: tuple, on_progress: Callback | None,
+                   source: str | None) -> Any:
+        pass
+
+    def cancel(self, uid: str) -> bool:
+        """
+        Cancel the job `uid`, whether it is waiting or running.
+
+        Returns:
+            bool: the job was found.
+        """
+        return self._scheduler.cancel(uid) or self._cancel(uid)
+
+    @abstractmethod
+    def _cancel(self, uid: str) -> bool:
+        """Cancel the job `uid` if it is running, return whether it was."""
+
+    def shutdown(self) -> None:
+        """Stop every job."""
+        self._scheduler.cancel_all()
+        self._shutdown()
+
+    @abstractmethod
+    def _shutdown(self) -> None:
+        pass
+
+class ThreadJobExecutor(JobExecutor):
+    """Jobs on a thread pool. Running jobs cannot be stopped, only the waiting ones."""
+    def __init__(self, workers: int | None = None, max_queue: int = 16, max_cost: float = 0.0,
+                 max_delay: float = 30.0, source_cache_bytes: int | None = None):
+        super().__init__(workers, max_queue, max_cost, max_delay, source_cache_bytes)
+        if source_cache_bytes is not None: # the jobs run in this process.
+            SOURCES.max_bytes = source_cache_bytes
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._futures: dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def _thread_main(self, fn: Callable, args: tuple, on_progress: Callback) -> tuple:
+        with self._lock:
+            self._running += 1
+        with collect() as timings, reporting(on_progress):
+            try:
+                return True, fn(*args), timings
+            except Exception as e: # pylint: disable=broad-exception-caught
+                return False, e, timings
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    async def _run(self, uid: str, fn: Callable, args: tuple, on_progress: Callback | None,
+                   source: str | None) -> Any:
+        loop = asyncio.get_running_loop()
+
+        def forward(stage: str, progress: float):
+            if on_progress is not None:
+                loop.call_soon_threadsafe(on_progress, stage, progress)
+        future = loop.run_in_executor(self._executor, self._thread_main, fn, args, forward)
+        self._futures[uid] = future
+        try:
+            succeeded, result, timings = await future
+        finally:
+            self._futures.pop(uid, None)
+        record_all(timings)
+        if not succeeded:
+            raise result
+        return result
+
+    def _cancel(self, uid: str) -> bool:
+        future = self._futures.get(uid)
+        if future is None:
+            return False
+        future.cancel()
+        return True
+
+    def _shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def _worker_main(conn, source_cache_bytes: int | None):
+    """
+    Entry of a worker process, run the `(fn, args)` sent on `conn` one after the other. Send \
+    `("progress", stage, progress)` while running, then `("result", succeeded, result or \
+    exception, stage timings)`. Exit once `conn` is closed, the executor is gone then. While \
+    idle, the uploads removed meanwhile are dropped from `SOURCES` now and then.
+    """
+    if source_cache_bytes is not None:
+        SOURCES.max_bytes = source_cache_bytes
+    while True:
+        if not conn.poll(_PRUNE_INTERVAL):
+            SOURCES.prune()
+            continue
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        with collect() as timings, reporting(lambda *progress: conn.send(("progress", *progress))):
+            try:
+                answer = (True, fn(*args))
+            except BaseException as e: # pylint: disable=broad-exception-caught
+                answer = (False, e)
+        conn.send(("result", *answer, timings))
+
+@dataclass
+class _Worker:
+    process: multiprocessing.Process
+    conn: Any
+    # uploads of its last jobs, oldest first, what its `SOURCES` likely holds.
+    sources: dict[str, None] = field(default_factory=dict)
+
+def _stop_workers(idle: list[_Worker], busy: dict[str, _Worker]):
+    """Terminate every worker, `ProcessJobExecutor._run` cleans up after the busy ones."""
+    for worker in busy.values():
+        worker.process.terminate()
+    for worker in idle:
+        worker.process.terminate()
+        worker.conn.close()
+    idle.clear()
+
+async def _readable(fd: int):
+    """Wait on the event loop for `fd` to be readable, or closed."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+    loop.add_reader(fd, ready)
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+
+class ProcessJobExecutor(JobExecutor):
+    """
+    A pool of at most `workers` processes, started when first needed and kept for the next \
+    jobs, so what they import or decode (see `SOURCES`) is there for those. A job goes to the \
+    idle worker which ran the last ones of its upload, the `source_cache_bytes` are split \
+    between the workers. Cancelling \
+    terminates the process of the job, so the CPU is given back right away, and a new one takes \
+    its place when needed. The processes come from a fork server, not from a fork of the web \
+    process and its threads.
+    """
+    def __init__(self, workers: int | None = None, max_queue: int = 16, max_cost: float = 0.0,
+                 max_delay: float = 30.0, source_cache_bytes: int | None = None):
+        super().__init__(workers, max_queue, max_cost, max_delay, source_cache_bytes)
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn")
+        if "forkserver" in methods: # the workers start with numpy and PIL imported.
+            self._context.set_forkserver_preload([__name__])
+        self._idle: list[_Worker] = []
+        self._busy: dict[str, _Worker] = {}
+        self._cancelled: set[str] = set()
+        # workers are not daemons, the interpreter would wait for them forever at exit.
+        weakref.finalize(self, _stop_workers, self._idle, self._busy)
+
+    async def _take_worker(self, source: str | None) -> _Worker:
+        # the worker which decoded `source` first, else the last one to finish.
+        self._idle.sort(key=lambda worker: source in worker.sources)
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.process.is_alive():
+                break
+            worker.conn.close() # killed while idle, by the OOM killer say.
+            worker.process.join()
+        else:
+            worker = await asyncio.to_thread(self._start_worker)
+        if source is not None:
+            worker.sources.pop(source, None)
+            worker.sources[source] = None
+            while len(worker.sources) > _WORKER_SOURCES:
+                del worker.sources[next(iter(worker.sources))]
+        return worker
+
+    def _start_worker(self) -> _Worker:
+        conn, child_conn = self._context.Pipe()
+        # not a daemon, so a job can have a pool of its own (see `animation`).
+        process = self._context.Process(target=_worker_main, args=(
+            child_conn, None if self.source_cache_bytes is None else
+            self.source_cache_bytes // self.workers))
+        process.start()
+        child_conn.close()
+        return _Worker(process, conn)
+
+    @staticmethod
+    async def _stop_worker(worker: _Worker):
+        worker.process.terminate()
+        worker.conn.close()
+        await _readable(worker.process.sentinel)
+        worker.process.join()
+
+    async def _run(self, uid: str, fn: Callable, args: tuple, on_progress: Callback | None,
+                   source: str | None) -> Any:
+        # the scheduler lets at most `workers` jobs in, so never more processes than that.
+        worker = await self._take_worker(source)
+        self._busy[uid] = worker
+        self._running += 1
+        finished = False
+        try:
+            worker.conn.send((fn, args))
+            while True:
+                await _readable(worker.conn.fileno())
+                if (message := worker.conn.recv())[0] != "progress":
+                    break
+                if on_progress is not None:
+                    on_progress(*message[1:])
+            _, succeeded, result, timings = message
+            finished = True
+        except (EOFError, ConnectionError) as err: # the process died before answering.
+            if uid in self._cancelled:
+                raise asyncio.CancelledError() from err
+            await _readable(worker.process.sentinel)
+            raise RuntimeError(f"Job process exited with {worker.process.exitcode}.") from err
+        finally: # a process stopped half way through a job is not reused.
+            self._running -= 1
+            self._busy.pop(uid, None)
+            self._cancelled.discard(uid)
+            if finished:
+                self._idle.append(worker)
+            else:
+                await self._stop_worker(worker)
+        record_all(timings)
+        if not succeeded:
+            raise result
+        return result
+
+    def _cancel(self, uid: str) -> bool:
+        worker = self._busy.get(uid)
+        if worker is None:
+            return False
+        self._cancelled.add(uid)
+        worker.process.terminate()
+        return True
+
+    def _shutdown(self) -> None:
+        _stop_workers(self._idle, self._busy)
+
+def create_executor(backend: str, workers: int | None = None, max_queue: int = 16,
+                    max_cost: float = 0.0, max_delay: float = 30.0,
+                    source_cache_bytes: int | None = None) -> JobExecutor:
+    """
+    Create the executor of `backend`.
+
+    Args:
+        backend (str): "process" or "thread".
+        workers (int | None): jobs running at once, None for the number of cores.
+        max_queue (int): jobs allowed to wait.
+        max_cost (float): estimated cost allowed outstanding, 0 for no limit.
+        max_delay (float): seconds a waiting job can be passed over by cheaper ones.
+        source_cache_bytes (int | None): decoded uploads kept by the processes running jobs.
+
+    Returns:
+        JobExecutor: the executor.
+    """
+    assert backend in BACKENDS, f"Invalid executor backend (should be one of {BACKENDS})."
+    if backend == "process":
+        return ProcessJobExecutor(workers, max_queue, max_cost, max_delay, source_cache_bytes)
+    return ThreadJobExecutor(workers, max_queue, max_cost, max_delay, source_cache_bytes)
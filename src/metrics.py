@@ -0,0 +1,231 @@
+"""
+Counters, gauges and histograms in the Prometheus text format, and timing of the stages of work.
+```
+with stage("generate"):
+    ...
+print(METRICS.render())
+```
+A stage timed while `collect()` is active goes to its list instead of the histogram, so the \
+timings of a job can travel back from another process, or end up in a `Server-Timing` header.
+"""
+
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# upper bounds in seconds, from a cached small preview to an 8K separate.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+Labels = tuple[tuple[str, str], ...]
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+    pairs = (*labels, extra) if extra else labels
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """Lines of the samples, without the HELP and TYPE lines."""
+
+class Counter(_Metric):
+    """A value that only goes up, per set of labels."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Add `amount` to the counter of `labels`."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format(labels)} {value:g}"
+
+class Gauge(_Metric):
+    """A value read when scraped, from `callback` or from what was set."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float] | None = None):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self._values: dict[Labels, float] = {}
+
+    def set(self, value: float, **labels: str):
+        """Set the gauge of `labels`."""
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Move the gauge of `labels` by `amount`."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        """Move the gauge of `labels` by `-amount`."""
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[str]:
+        if self.callback is not None:
+            yield f"{self.name} {self.callback():g}"
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format(labels)} {value:g}"
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, per set of labels."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: count of each bucket (the last one is +Inf), then the sum.
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Count `value` for `labels`."""
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(labels, list(counts), total[0])
+                      for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket{_format(labels, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{_format(labels)} {total:g}"
+            yield f"{self.name}_count{_format(labels)} {cumulative}"
+
+class Metrics:
+    """Every metric of the process, rendered together."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        """The counter `name`, created on first call."""
+        return self._add(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str,
+              callback: Callable[[], float] | None = None) -> Gauge:
+        """The gauge `name`, created on first call. A `callback` replaces the previous one."""
+        gauge = self._add(Gauge(name, documentation, callback))
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name: str, documentation: str,
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """The histogram `name`, created on first call."""
+        return self._add(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text format (version 0.0.4).
+
+        Returns:
+            str: the exposition.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = METRICS.histogram("qp_stage_seconds", "Seconds spent in each stage of the work.")
+
+### ------------------------------ stage timing ---------------------------------------
+
+_timings: ContextVar[list[tuple[str, float]] | None] = ContextVar("qp_timings", default=None)
+
+def record(name: str, seconds: float):
+    """Add a timing of the stage `name`, to what `collect()` gathers or else the histogram."""
+    timings = _timings.get()
+    if timings is None:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    else:
+        timings.append((name, seconds))
+
+def record_all(timings: list[tuple[str, float]]):
+    """`record` every timing of `timings`, as `collect()` gathered them."""
+    for name, seconds in timings:
+        record(name, seconds)
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the block as the stage `name`, see `record`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+@contextmanager
+def collect() -> Iterator[list[tuple[str, float]]]:
+    """Gather the stages timed within the block into the returned list, in order."""
+    timings: list[tuple[str, float]] = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+def server_timing(timings: list[tuple[str, float]]) -> str:
+    """
+    The `Server-Timing` header of `timings`, the durations of a stage are added up.
+
+    Args:
+        timings (list[tuple[str, float]]): what `collect()` gathered.
+
+    Returns:
+        str: the header value.
+    """
+    totals: dict[str, float] = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0) + seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
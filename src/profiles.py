@@ -0,0 +1,91 @@
+"""
+Named trade-offs between encoding speed and file size, for every image the package writes.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from PIL import Image
+
+from .metrics import stage
+
+@dataclass(frozen=True)
+class Profile:
+    """
+    How PNG and WebP files are encoded.
+
+    Args:
+        png_compress_level (int): zlib level of PNG, 0 (none) to 9 (smallest).
+        png_optimize (bool): let PIL search for a smaller PNG encoding, slow.
+        webp_quality (int): quality of lossy WebP (0-100), the size of lossless.
+        webp_method (int): effort of WebP, 0 (fast) to 6 (smallest).
+        webp_lossless (bool): encode WebP without loss.
+    """
+    png_compress_level: int
+    png_optimize: bool
+    webp_quality: int
+    webp_method: int
+    webp_lossless: bool = False
+
+PROFILES: dict[str, Profile] = {
+    "fast": Profile(png_compress_level=1, png_optimize=False, webp_quality=80, webp_method=0),
+    # the defaults of PIL, what was written before profiles existed.
+    "balanced": Profile(png_compress_level=6, png_optimize=False, webp_quality=80, webp_method=4),
+    "small": Profile(png_compress_level=9, png_optimize=True, webp_quality=75, webp_method=6),
+}
+DEFAULT_PROFILE = "balanced"
+
+def get_profile(profile: str | Profile) -> Profile:
+    """
+    The profile named `profile`, a `Profile` is returned as is.
+
+    Args:
+        profile (str | Profile): a name of `PROFILES` or a profile.
+
+    Returns:
+        Profile: the profile.
+    """
+    if isinstance(profile, Profile):
+        return profile
+    assert profile in PROFILES, f"Invalid profile (should be one of {tuple(PROFILES)})."
+    return PROFILES[profile]
+
+def save_options(image_format: str, profile: str | Profile = DEFAULT_PROFILE) -> dict:
+    """
+    Keyword arguments of `Image.save` for `image_format` under `profile`.
+
+    Args:
+        image_format (str): "png", "webp" or anything else (no options then).
+        profile (str | Profile): the profile.
+
+    Returns:
+        dict: the options, with the format.
+    """
+    profile = get_profile(profile)
+    match image_format.lower():
+        case "png":
+            return {"format": "png", "compress_level": profile.png_compress_level,
+                    "optimize": profile.png_optimize}
+        case "webp":
+            return {"format": "webp", "quality": profile.webp_quality,
+                    "method": profile.webp_method, "lossless": profile.webp_lossless}
+    return {"format": image_format}
+
+def save(image: Image.Image, fp: str | BinaryIO, profile: str | Profile = DEFAULT_PROFILE,
+         image_format: str | None = None):
+    """
+    Save `image` with the options of `profile`.
+
+    Args:
+        image (Image.Image): the image.
+        fp (str | BinaryIO): a path or a file object.
+        profile (str | Profile): the profile.
+        image_format (str | None): the format, None to take it from the extension of `fp` \
+            (PNG when there is none).
+    """
+    if image_format is None:
+        ext = os.path.splitext(fp)[1] if isinstance(fp, str) else ""
+        image_format = Image.registered_extensions().get(ext.lower(), "png")
+    with stage("save"):
+        image.save(fp, **save_options(image_format, profile))
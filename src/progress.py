@@ -0,0 +1,67 @@
+"""
+Progress of the running work, reported to whoever listens with little cost.
+```
+with reporting(lambda stage, progress: print(stage, progress)):
+    Generator("Path/to/image.png").preview(0.5)
+```
+"""
+
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+Callback = Callable[[str, float], None]
+
+class _Reporter:
+    """Forward reports to `callback`, at most once per `interval` seconds for each stage."""
+    def __init__(self, callback: Callback, interval: float):
+        self.callback = callback
+        self.interval = interval
+        self._stage = ""
+        self._last = 0.0
+
+    def __call__(self, stage: str, progress: float):
+        now = time.monotonic()
+        if stage == self._stage and progress < 1 and now - self._last < self.interval:
+            return
+        self._stage, self._last = stage, now
+        self.callback(stage, progress)
+
+_reporter: ContextVar[_Reporter | None] = ContextVar("qp_reporter", default=None)
+
+def report(stage: str, progress: float):
+    """
+    Report that the work is `progress` (0-1) through `stage`. Does nothing out of `reporting`.
+
+    Args:
+        stage (str): what is being done.
+        progress (float): how far.
+    """
+    reporter = _reporter.get()
+    if reporter is not None:
+        reporter(stage, min(max(progress, 0.0), 1.0))
+
+@contextmanager
+def silenced() -> Iterator[None]:
+    """Drop what is reported within the block, for a part of work which reports as a whole."""
+    token = _reporter.set(None)
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
+
+@contextmanager
+def reporting(callback: Callback, interval: float = 0.25) -> Iterator[None]:
+    """
+    Send what is reported within the block to `callback(stage, progress)`, throttled.
+
+    Args:
+        callback (Callback): the listener.
+        interval (float): seconds between two reports of the same stage.
+    """
+    token = _reporter.set(_Reporter(callback, interval))
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
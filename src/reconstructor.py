@@ -3,55 +3,80 @@
 Reconstruct the alter layers.
 """
 
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
 from PIL import Image
 
+# 255 * 257 overflows uint16, so widen the sum before the 258th layer.
+_UINT16_LAYERS = 257
+
 class Reconstructor:
     """
     The reconstructor. (STILL IN DEVELOPMENT AND NOT YET READY FOR DEPLOYMENT.) #TODO
     """
     def __init__(self):
-        self.layers: list[Image.Image] = []
+        self.count: int = 0
+        self._summed: np.ndarray | None = None
+
+    @staticmethod
+    def _load(img: str | Image.Image | np.ndarray) -> np.ndarray:
+        if isinstance(img, str): # is a path.
+            img = Image.open(img)
+        if isinstance(img, Image.Image): # is a pure image.
+            img = np.asarray(img.convert("RGB"))
+        return img
 
     def add_layer(self, img: str | Image.Image | np.ndarray) -> None:
         """
-        add layer to compile.
+        add layer to compile. Only the running sum is kept, the layer can be freed right after.
 
 
         Args:
             img (str | Image.Image | np.ndarray): the layer to add, can be path or pure image.
         """
-        if isinstance(img, str): # is a path.
-            img = Image.open(img)
-        if isinstance(img, Image.Image): # is a pure image.
-            img = np.array(img.convert("RGB"))
+        img = self._load(img)
 
-        if self.layers and img.shape != self.layers[0].shape:
-            raise ValueError("all layers must have the same shape")
-        self.layers.append(img)
+        if self._summed is None:
+            self._summed = img.astype(np.uint16)
+        else:
+            if img.shape != self._summed.shape:
+                raise ValueError("all layers must have the same shape")
+            if self.count >= _UINT16_LAYERS and self._summed.dtype == np.uint16:
+                self._summed = self._summed.astype(np.uint32)
+            self._summed += img.astype(self._summed.dtype, copy=False)
+        self.count += 1
+
+    def add_layers(self, imgs: Iterable[str | Image.Image | np.ndarray],
+                   workers: int | None = None) -> None:
+        """
+        add many layers, decoding them on a thread pool. Layers are summed as soon as they are \
+        decoded, in whatever order they finish.
+
+
+        Args:
+            imgs (Iterable[str | Image.Image | np.ndarray]): the layers to add.
+            workers (int | None): number of decoding threads, None for the default.
+        """
+        with ThreadPoolExecutor(workers) as executor:
+            for future in as_completed([executor.submit(self._load, img) for img in imgs]):
+                self.add_layer(future.result())
 
     def reconstruct(self) -> Image.Image:
         """
         Reconstruct the layers into one image.
         ```
         reconstructor = Reconstructor()
-        reconstructor.reconstruct([layer1, layer2, ...])
+        reconstructor.add_layers(["layer_0.png", "layer_1.png", ...])
+        reconstructor.reconstruct().show()
         ```
-
-        Args:
-            layers (list): list of layers to reconstruct.
         """
 
-        assert self.layers, "no layers to reconstruct"
-
-        # Ensure identical shapes
-        first_shape = self.layers[0].shape
-        if any(layer.shape != first_shape for layer in self.layers):
-            raise ValueError("all layers must have the same shape")
+        assert self._summed is not None, "no layers to reconstruct"
 
         # new[0][0][0] = layer1[0][0][0] + layer2[0][0][0] + ...
-        summed = np.sum(np.stack(self.layers, axis=0), axis=0)
-        summed = np.clip(summed, 0, 255).astype(np.uint8)
+        summed = np.clip(self._summed, 0, 255).astype(np.uint8)
         return Image.fromarray(summed)
 
 if __name__ == "__main__":
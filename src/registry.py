@@ -0,0 +1,298 @@
+# cspell:ignore isolation_level
+"""
+Where the web service keeps track of its jobs, shared between workers with SQLite.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+BACKENDS = ("memory", "sqlite")
+
+# statuses a job can be in, the last three are final.
+STATUSES = ("uploaded", "pending", "running", "cancelling", "done", "failed", "cancelled")
+UNFINISHED = ("pending", "running")
+FINISHED = ("done", "failed", "cancelled")
+
+@dataclass
+class Job:
+    """
+    A job, or an upload waiting for its jobs.
+
+    Args:
+        uid (str): id of the job.
+        owner (str): the uploaded file the job works on.
+        status (str): one of `STATUSES`.
+        outputs (list[str]): files the job saved next to the owner.
+        expires_at (float): unix time after which the job and its files are removed.
+        digest (str | None): sha256 of the upload, kept on its "uploaded" record.
+        stage (str): what the job is doing, as last reported.
+        progress (float): how far the job is in `stage` (0-1).
+    """
+    uid: str
+    owner: str
+    status: str
+    outputs: list[str] = field(default_factory=list)
+    expires_at: float = 0
+    digest: str | None = None
+    stage: str = ""
+    progress: float = 0
+
+class JobRegistry(ABC):
+    """Jobs by id, owner and expiry."""
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+
+    def create(self, uid: str, owner: str, status: str = "pending",
+               digest: str | None = None) -> Job:
+        """
+        Register a new job, expiring `ttl` seconds from now.
+
+        Args:
+            uid (str): id of the job.
+            owner (str): the uploaded file the job works on.
+            status (str): starting status.
+            digest (str | None): sha256 of the upload.
+
+        Returns:
+            Job: the job.
+        """
+        assert status in STATUSES, f"Invalid status (should be one of {STATUSES})."
+        job = Job(uid, owner, status, [], time.time() + self.ttl, digest)
+        self._insert(job)
+        return job
+
+    @abstractmethod
+    def _insert(self, job: Job) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, uid: str) -> Job | None:
+        """The job `uid`, None if unknown."""
+
+    @abstractmethod
+    def set_status(self, uid: str, status: str) -> None:
+        """Move the job `uid` to `status`. A job being cancelled only moves to a final status."""
+
+    @abstractmethod
+    def add_output(self, uid: str, output: str) -> None:
+        """Remember that the job `uid` saved `output`."""
+
+    @abstractmethod
+    def set_progress(self, uid: str, stage: str, progress: float) -> None:
+        """Remember how far the job `uid` is, as it reported."""
+
+    @abstractmethod
+    def of_owner(self, owner: str) -> list[Job]:
+        """Every job of `owner`."""
+
+    @abstractmethod
+    def request_cancel(self, owner: str) -> list[str]:
+        """Mark the unfinished jobs of `owner` as cancelling, return their ids."""
+
+    @abstractmethod
+    def request_cancel_job(self, uid: str) -> bool:
+        """Mark the job `uid` as cancelling if unfinished, return whether it was."""
+
+    @abstractmethod
+    def cancelling(self) -> list[str]:
+        """Ids of the jobs waiting to be cancelled, by whichever worker runs them."""
+
+    @abstractmethod
+    def expired(self, now: float | None = None) -> list[Job]:
+        """Jobs whose expiry passed."""
+
+    @abstractmethod
+    def delete(self, uids: list[str]) -> None:
+        """Forget the jobs `uids`."""
+
+    def close(self) -> None:
+        """Release what the registry holds."""
+
+class MemoryJobRegistry(JobRegistry):
+    """Jobs in a dict, only seen by this process."""
+    def __init__(self, ttl: float = 3600):
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+
+    def _insert(self, job: Job) -> None:
+        with self._lock:
+            self._jobs[job.uid] = job
+
+    def get(self, uid: str) -> Job | None:
+        return self._jobs.get(uid)
+
+    def set_status(self, uid: str, status: str) -> None:
+        assert status in STATUSES, f"Invalid status (should be one of {STATUSES})."
+        with self._lock:
+            job = self._jobs.get(uid)
+            if job is not None and (job.status != "cancelling" or status not in UNFINISHED):
+                job.status = status
+
+    def add_output(self, uid: str, output: str) -> None:
+        with self._lock:
+            if uid in self._jobs:
+                self._jobs[uid].outputs.append(output)
+
+    def set_progress(self, uid: str, stage: str, progress: float) -> None:
+        with self._lock:
+            if uid in self._jobs:
+                self._jobs[uid].stage, self._jobs[uid].progress = stage, progress
+
+    def of_owner(self, owner: str) -> list[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def request_cancel(self, owner: str) -> list[str]:
+        with self._lock:
+            jobs = [job for job in self._jobs.values()
+                    if job.owner == owner and job.status in UNFINISHED]
+            for job in jobs:
+                job.status = "cancelling"
+            return [job.uid for job in jobs]
+
+    def request_cancel_job(self, uid: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(uid)
+            if job is None or job.status not in UNFINISHED:
+                return False
+            job.status = "cancelling"
+            return True
+
+    def cancelling(self) -> list[str]:
+        with self._lock:
+            return [job.uid for job in self._jobs.values() if job.status == "cancelling"]
+
+    def expired(self, now: float | None = None) -> list[Job]:
+        now = time.time() if now is None else now
+        with self._lock:
+            return [job for job in self._jobs.values() if job.expires_at <= now]
+
+    def delete(self, uids: list[str]) -> None:
+        with self._lock:
+            for uid in uids:
+                self._jobs.pop(uid, None)
+
+class SQLiteJobRegistry(JobRegistry):
+    """
+    Jobs in a SQLite database in WAL mode, shared by every worker on the machine. A call waits \
+    for the database, up to 10 s when another worker holds it, so the web service makes them \
+    in threads rather than on its event loop.
+    """
+    def __init__(self, path: str, ttl: float = 3600):
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                uid TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                status TEXT NOT NULL,
+                outputs TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                digest TEXT,
+                stage TEXT NOT NULL DEFAULT '',
+                progress REAL NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner);
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at);
+        """)
+        # databases made before progress was tracked.
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("stage", "TEXT NOT NULL DEFAULT ''"),
+                                   ("progress", "REAL NOT NULL DEFAULT 0")):
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def _execute(self, query: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    # every query selects these, in this order.
+    _COLUMNS = "uid, owner, status, outputs, expires_at, digest, stage, progress"
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        return Job(row[0], row[1], row[2], json.loads(row[3]), row[4], row[5], row[6], row[7])
+
+    def _insert(self, job: Job) -> None:
+        self._execute(f"INSERT OR REPLACE INTO jobs ({self._COLUMNS}) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (job.uid, job.owner, job.status, json.dumps(job.outputs), job.expires_at,
+                       job.digest, job.stage, job.progress))
+
+    def get(self, uid: str) -> Job | None:
+        rows = self._execute(f"SELECT {self._COLUMNS} FROM jobs WHERE uid = ?", (uid,))
+        return self._job(rows[0]) if rows else None
+
+    def set_status(self, uid: str, status: str) -> None:
+        assert status in STATUSES, f"Invalid status (should be one of {STATUSES})."
+        if status in UNFINISHED:
+            self._execute("UPDATE jobs SET status = ? WHERE uid = ? AND status != 'cancelling'",
+                          (status, uid))
+        else:
+            self._execute("UPDATE jobs SET status = ? WHERE uid = ?", (status, uid))
+
+    def add_output(self, uid: str, output: str) -> None:
+        self._execute("UPDATE jobs SET outputs = json_insert(outputs, '$[#]', ?) WHERE uid = ?",
+                      (output, uid))
+
+    def set_progress(self, uid: str, stage: str, progress: float) -> None:
+        self._execute("UPDATE jobs SET stage = ?, progress = ? WHERE uid = ?",
+                      (stage, progress, uid))
+
+    def of_owner(self, owner: str) -> list[Job]:
+        return [self._job(row) for row in self._execute(
+            f"SELECT {self._COLUMNS} FROM jobs WHERE owner = ?", (owner,))]
+
+    def request_cancel(self, owner: str) -> list[str]:
+        rows = self._execute("UPDATE jobs SET status = 'cancelling' WHERE owner = ? AND status "
+                             "IN ('pending', 'running') RETURNING uid", (owner,))
+        return [row[0] for row in rows]
+
+    def request_cancel_job(self, uid: str) -> bool:
+        return bool(self._execute("UPDATE jobs SET status = 'cancelling' WHERE uid = ? AND status "
+                                  "IN ('pending', 'running') RETURNING uid", (uid,)))
+
+    def cancelling(self) -> list[str]:
+        return [row[0] for row in self._execute("SELECT uid FROM jobs WHERE status = 'cancelling'")]
+
+    def expired(self, now: float | None = None) -> list[Job]:
+        now = time.time() if now is None else now
+        return [self._job(row) for row in self._execute(
+            f"SELECT {self._COLUMNS} FROM jobs WHERE expires_at <= ?", (now,))]
+
+    def delete(self, uids: list[str]) -> None:
+        with self._lock:
+            self._connection.executemany("DELETE FROM jobs WHERE uid = ?",
+                                         [(uid,) for uid in uids])
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+def create_registry(backend: str, path: str | None = None, ttl: float = 3600) -> JobRegistry:
+    """
+    Create the registry of `backend`.
+
+    Args:
+        backend (str): "memory" or "sqlite".
+        path (str | None): database file of the "sqlite" backend.
+        ttl (float): seconds a job lives.
+
+    Returns:
+        JobRegistry: the registry.
+    """
+    assert backend in BACKENDS, f"Invalid registry backend (should be one of {BACKENDS})."
+    if backend == "sqlite":
+        assert path, "The sqlite registry needs a path."
+        return SQLiteJobRegistry(path, ttl)
+    return MemoryJobRegistry(ttl)
@@ -0,0 +1,153 @@
+"""
+Guess what a job costs before running it, and decide which waiting job gets the next worker.
+```
+cost = estimate_cost("preview", image_pixels("Path/to/image.png"), intensity=0.5)
+```
+"""
+
+import time
+import asyncio
+import itertools
+from dataclasses import dataclass
+
+from PIL import Image
+
+# seconds of one core per megapixel, roughly what `benchmarks/bench.py` measures at intensity 1,
+# saving the result included. "preview_sweep" is per preview.
+SECONDS_PER_MEGAPIXEL = {
+    "preview": 0.5,
+    "preview_steganography": 1.2,
+    "steganography": 1.0,
+    "decode": 0.4,
+    "preview_sweep": 0.45,
+}
+# share of the preview cost which is not drawing, so does not go with the intensity.
+_FIXED_SHARE = 0.7
+
+def image_pixels(path: str) -> int:
+    """Pixels of every frame of the image at `path`, from its header only."""
+    with Image.open(path) as img:
+        return img.width * img.height * getattr(img, "n_frames", 1)
+
+def estimate_cost(operation: str, pixels: int, intensity: float = 1.0, count: int = 1) -> float:
+    """
+    Estimate the seconds of one core a job takes.
+
+    Args:
+        operation (str): a key of `SECONDS_PER_MEGAPIXEL`.
+        pixels (int): pixels of the image worked on, see `image_pixels`.
+        intensity (float): intensity of a preview (0-1), the highest one of a sweep.
+        count (int): previews of a sweep.
+
+    Returns:
+        float: the cost.
+    """
+    assert operation in SECONDS_PER_MEGAPIXEL, \
+        f"Invalid operation (should be one of {tuple(SECONDS_PER_MEGAPIXEL)})."
+    cost = SECONDS_PER_MEGAPIXEL[operation] * pixels / 1e6 * count
+    if operation.startswith("preview"):
+        cost *= _FIXED_SHARE + (1 - _FIXED_SHARE) * intensity
+    return cost
+
+@dataclass
+class _Waiting:
+    uid: str
+    cost: float
+    client: str
+    order: int
+    since: float
+    future: asyncio.Future
+
+class Scheduler:
+    """
+    Hand `slots` out to the waiting jobs. The client with the fewest jobs running goes first, \
+    then the one served the fewest times since it last had nothing to do, then the cheapest \
+    job, then the oldest one. A job passed over for `max_delay` seconds goes ahead of the \
+    others, so a large one is never starved by a stream of small ones.
+    """
+    def __init__(self, slots: int, max_delay: float = 30.0):
+        self.slots = slots
+        self.max_delay = max_delay
+        self._free = slots
+        self._waiting: dict[str, _Waiting] = {}
+        self._running: dict[str, int] = {} # client -> jobs running.
+        self._clients: dict[str, str] = {} # uid -> client, of the jobs running.
+        self._turns: dict[str, int] = {} # client -> jobs started while it had some to do.
+        self._order = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        """Jobs waiting for a slot."""
+        return len(self._waiting)
+
+    async def acquire(self, uid: str, cost: float = 0.0, client: str = ""):
+        """
+        Wait for a slot for the job `uid`, give it back with `release`.
+
+        Raises:
+            asyncio.CancelledError: the job got cancelled while waiting.
+        """
+        if self._free > 0 and not self._waiting:
+            self._start(uid, client)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[uid] = _Waiting(uid, cost, client, next(self._order), time.monotonic(),
+                                      future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._waiting.pop(uid, None)
+            if future.done() and not future.cancelled(): # the slot came just as it left.
+                self.release(uid)
+            raise
+
+    def release(self, uid: str):
+        """Give back the slot of the job `uid` to the next one waiting."""
+        client = self._clients.pop(uid)
+        self._running[client] -= 1
+        if not self._running[client]:
+            del self._running[client]
+        self._free += 1
+        self._forget(client)
+        self._dispatch()
+
+    def cancel(self, uid: str) -> bool:
+        """
+        Cancel the job `uid` if it is waiting.
+
+        Returns:
+            bool: the job was waiting.
+        """
+        job = self._waiting.pop(uid, None)
+        if job is None:
+            return False
+        job.future.cancel()
+        self._forget(job.client)
+        return True
+
+    def cancel_all(self):
+        """Cancel every job waiting."""
+        for uid in list(self._waiting):
+            self.cancel(uid)
+
+    def _start(self, uid: str, client: str):
+        self._free -= 1
+        self._clients[uid] = client
+        self._running[client] = self._running.get(client, 0) + 1
+        self._turns[client] = self._turns.get(client, 0) + 1
+
+    def _forget(self, client: str):
+        """Reset the turns of `client` once it has nothing running or waiting."""
+        if client not in self._running and all(w.client != client
+                                               for w in self._waiting.values()):
+            self._turns.pop(client, None)
+
+    def _dispatch(self):
+        while self._free > 0 and self._waiting:
+            now = time.monotonic()
+            job = min(self._waiting.values(), key=lambda w: (
+                now - w.since < self.max_delay, self._running.get(w.client, 0),
+                self._turns.get(w.client, 0), w.cost, w.order))
+            del self._waiting[job.uid]
+            self._start(job.uid, job.client)
+            job.future.set_result(None)
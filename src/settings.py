@@ -0,0 +1,77 @@
+"""
+Settings of the web service, read from `QP_*` environment variables.
+"""
+
+import os
+from dataclasses import dataclass, fields
+
+def _parse(value: str, kind: type):
+    """Convert an environment variable into the type of the field, "" means None if allowed."""
+    if value == "" and kind not in (str, bool):
+        return None
+    if kind is bool:
+        return value.lower() in ("1", "true", "yes", "on")
+    for cast in (int, float, str):
+        if kind is cast or cast in getattr(kind, "__args__", ()):
+            return cast(value)
+    raise TypeError(f"Unsupported setting type {kind}")
+
+@dataclass
+class Settings:
+    """
+    Every knob of the web service, each one can be set by `QP_<NAME>` in the environment.
+
+    Args:
+        executor (str): "process" or "thread", where the heavy jobs run.
+        workers (int | None): jobs running at once, None for the number of cores.
+        max_queue (int): jobs allowed to wait for a worker before new ones get a 503.
+        cost_budget (float): estimated seconds of one core allowed running or waiting, new jobs \
+            beyond get a 503 (one alone is always taken). 0 for no limit.
+        max_delay (float): seconds a waiting job can be passed over by cheaper ones.
+        client_header (str): header set by a trusted proxy with the address of the client, as \
+            `X-Forwarded-For`, the first address of which tells clients apart. "" for the peer \
+            address, the proxy itself when there is one.
+        retry_after (int): seconds told to clients in `Retry-After` when the queue is full.
+        cache_dir (str | None): where finished results are cached, None for `src/cache`.
+        cache_max_bytes (int): size of the result cache, 0 to disable it.
+        source_cache_bytes (int): size of the decoded uploads kept in memory, split between \
+            the processes running jobs, 0 to keep none.
+        registry (str): "memory" or "sqlite", the latter is needed to run several workers.
+        registry_path (str | None): database of the "sqlite" registry, None for \
+            `src/jobs.sqlite3`.
+        job_ttl (int): seconds uploads and results are kept.
+        max_upload_bytes (int): largest upload accepted.
+        codec_profile (str): "fast", "balanced" or "small", how results are encoded.
+        server_timing (bool): add a `Server-Timing` header with the stages of each request.
+        frame_workers (int | None): processes each animated preview spreads its frames over, \
+            None for the cores left to each job worker, at least 2 when there are \
+            several cores.
+    """
+    executor: str = "process"
+    workers: int | None = None
+    max_queue: int = 16
+    cost_budget: float = 600.0
+    max_delay: float = 30.0
+    client_header: str = ""
+    retry_after: int = 10
+    cache_dir: str | None = None
+    cache_max_bytes: int = 1 << 30
+    source_cache_bytes: int = 512 << 20
+    registry: str = "memory"
+    registry_path: str | None = None
+    job_ttl: int = 3600
+    max_upload_bytes: int = 1_073_741_824
+    codec_profile: str = "balanced"
+    server_timing: bool = False
+    frame_workers: int | None = None
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """
+        Build the settings from the environment, unset variables keep the defaults.
+
+        Returns:
+            Settings: the settings.
+        """
+        return cls(**{field.name: _parse(os.environ[f"QP_{field.name.upper()}"], field.type)
+                      for field in fields(cls) if f"QP_{field.name.upper()}" in os.environ})
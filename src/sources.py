@@ -0,0 +1,114 @@
+"""
+Keep decoded uploads in memory, so several requests on the same image decode it once.
+```
+decoded = SOURCES.get("Path/to/image.png")
+Generator(decoded.pixels, pixel_sum=decoded.pixel_sum).preview(0.5)
+```
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+from .generator import load_rgb
+from .metrics import stage
+
+@dataclass(frozen=True)
+class Decoded:
+    """
+    A decoded image.
+
+    Args:
+        pixels (np.ndarray): the RGB pixels, read-only.
+        pixel_sum (int): sum of `pixels`, what the allowances are taken from.
+        mode (str): mode of the file, the pixels lost the alpha of an "RGBA" one.
+    """
+    pixels: np.ndarray
+    pixel_sum: int
+    mode: str
+
+class SourceCache:
+    """
+    Decoded images keyed by path and modification time, so a rewritten file is decoded again. \
+    The least recently used ones are dropped once over `max_bytes`, 0 keeps none, and a miss \
+    drops the ones of rewritten or deleted files. Safe to use from several threads.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, int], Decoded] = OrderedDict() # oldest first.
+        self._size: int = 0
+
+    @property
+    def size(self) -> int:
+        """Bytes of pixels kept."""
+        return self._size
+
+    def get(self, path: str) -> Decoded:
+        """
+        The decoded image at `path`, from memory when it was decoded before.
+
+        Args:
+            path (str): the image file.
+
+        Returns:
+            Decoded: the image.
+        """
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            decoded = self._entries.get(key)
+            if decoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return decoded
+            self.misses += 1
+            self._prune(path)
+
+        with stage("decode"), Image.open(path) as img:
+            pixels = load_rgb(img)
+            mode = img.mode
+        pixels.flags.writeable = False
+        decoded = Decoded(pixels, int(np.sum(pixels)), mode)
+
+        with self._lock:
+            if key not in self._entries and pixels.nbytes <= self.max_bytes:
+                self._entries[key] = decoded
+                self._size += pixels.nbytes
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= evicted.pixels.nbytes
+        return decoded
+
+    def prune(self):
+        """Drop what was decoded from files deleted since, a job process does not hear of them."""
+        with self._lock:
+            self._prune()
+
+    def _prune(self, rewritten: str | None = None):
+        for key in [key for key in self._entries
+                    if key[0] == rewritten or not os.path.exists(key[0])]:
+            self._size -= self._entries.pop(key).pixels.nbytes
+
+    def invalidate(self, path: str):
+        """Drop what was decoded from `path`, call it when the file is deleted."""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._size -= self._entries.pop(key).pixels.nbytes
+
+    def clear(self):
+        """Drop everything."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+# the one of this process, the executor sets its size in every process running jobs: the web one
+# for threads, each worker for processes, which share the size then.
+SOURCES = SourceCache(512 << 20)
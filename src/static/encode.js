@@ -26,6 +26,7 @@
             const selected = document.querySelector('#tabs-headers .tab-btn.active').dataset.target;
             fd.append('save_path', save_path);
             fd.append('selected', selected);
+            fd.append('async', '1');
 
             const result = document.querySelector(`#${selected} #result`)
             result.textContent = 'Loading, please wait patiently.';
@@ -35,14 +36,111 @@
                     method: 'POST',
                     body: fd
                 });
-                const text = await r.text();
-                result.innerHTML = text;
+                if (r.status !== 202) { // errors come back as html.
+                    result.innerHTML = await r.text();
+                    return;
+                }
+                follow(await r.json(), result, selected === 'panel_preview' ? 'preview' : 'stegano');
             } catch (err) {
                 console.error(err);
             }
         });
     })
 
+    // previews of several intensities in one job, browsed with a slider.
+    const sweepBtn = document.getElementById('sweep-btn');
+    if (sweepBtn) {
+        sweepBtn.addEventListener('click', async () => {
+            const sweep = document.getElementById('sweep');
+            const intensities = Array.from({length: 10}, (_, i) => ((i + 1) / 10).toFixed(1));
+            const seed = Math.floor(Math.random() * 2 ** 31);
+            const fd = new FormData();
+            fd.append('intensities', intensities.join(','));
+            fd.append('seed', seed);
+            fd.append('async', '1');
+            sweep.textContent = 'Loading, please wait patiently.';
+
+            try {
+                const r = await fetch(`/preview/${location.pathname.split("/").pop()}`, {
+                    method: 'POST',
+                    body: fd
+                });
+                const answer = await r.json();
+                if (r.status !== 202) {
+                    sweep.textContent = answer.error;
+                    return;
+                }
+                follow(answer, sweep, 'preview',
+                       (state) => slider(sweep, state.urls, intensities, seed));
+            } catch (err) {
+                console.error(err);
+            }
+        });
+    }
+
+    function slider(sweep, urls, intensities, seed) {
+        sweep.innerHTML = '<label>Intensity <span id="sweep-value"></span></label>'
+            + '<input id="sweep-range" type="range" min="0" step="1"><br>'
+            + '<img id="sweep-image" alt="preview">';
+        urls.forEach((url) => { new Image().src = url; }); // no wait while sliding.
+        const range = sweep.querySelector('#sweep-range');
+        const form = document.querySelector('#panel_preview form');
+        range.max = urls.length - 1;
+        range.value = Math.floor(urls.length / 2);
+        const show = () => {
+            sweep.querySelector('#sweep-image').src = urls[range.value];
+            sweep.querySelector('#sweep-value').textContent = intensities[range.value];
+            // same seed, so Apply makes the very preview on screen.
+            form.elements.intensity.value = intensities[range.value];
+            form.elements.seed.value = seed;
+        };
+        range.addEventListener('input', show);
+        show();
+    }
+
+    // show the progress of a background job, then its result (or hand it to `onDone`).
+    function follow(job, result, img_name, onDone) {
+        result.innerHTML = '<p class="muted" id="progress"></p>'
+            + '<button class="actions" id="cancel-btn" type="button">Cancel</button>';
+        const progress = result.querySelector('#progress');
+        progress.textContent = 'Waiting for a free worker.';
+        result.querySelector('#cancel-btn').addEventListener('click', () => {
+            fetch(`/jobs/${job.job}/cancel`, {method: 'POST'});
+        });
+
+        const events = new EventSource(job.events);
+        events.addEventListener('progress', (e) => {
+            const state = JSON.parse(e.data);
+            if (state.stage) {
+                progress.textContent = `${state.stage}: ${Math.round(state.progress * 100)}%`;
+            }
+        });
+        events.addEventListener('done', (e) => {
+            events.close();
+            const state = JSON.parse(e.data);
+            if (onDone) {
+                onDone(state);
+                return;
+            }
+            result.innerHTML = '<h2>Result</h2><img id="result-image" alt="result image"><br><br>'
+                + '<a class="primary">Download</a>';
+            result.querySelector('#result-image').src = state.url;
+            const link = result.querySelector('a');
+            link.href = state.url;
+            link.download = `${img_name}.png`;
+        });
+        for (const status of ['failed', 'cancelled']) {
+            events.addEventListener(status, () => {
+                events.close();
+                result.innerHTML = '<p class="error"></p>';
+                result.querySelector('.error').textContent = status === 'cancelled'
+                    ? 'Cancelled.'
+                    : 'Cannot encode the image within. Try to decrease the size of real image '
+                        + 'size or increase the size of the disguise image.';
+            });
+        }
+    }
+
     // remove file when user left.
     window.addEventListener('beforeunload', () => {
         fetch(`/remove/${location.pathname.split("/").pop()}`, {
@@ -1,18 +1,355 @@
-# cspell:ignore stegano, computer-lizing
+# cspell:ignore stegano, computer-lizing, unpackbits, packbits
 """
 Do what is needed to be done.
 """
 
+import os
+import math
+import struct
+import zlib
+from dataclasses import dataclass
+from functools import cache
 from io import BytesIO
 from base64 import b85encode, b85decode
+from typing import BinaryIO
 
+import numpy as np
 from PIL import Image
 import stegano
 
+from .formats import sniff_format
+from .generator import Generator, Source
+from .metrics import stage
+from .progress import report
+from .profiles import DEFAULT_PROFILE, Profile, get_profile, save, save_options
+
+CODECS = ("native", "stegano")
+
+# magic, version, payload length, crc32 of the payload.
+_MAGIC = b"QPX"
+_VERSION = 1
+_HEADER = struct.Struct(">3sBII")
+
+# the lowest WebP quality tried when fitting.
+_MIN_QUALITY = 10
+
+# bytes of embedded data a probe reads: the native header and the start of the payload, or the
+# "<length>:" of stegano and the start of its base85.
+_PROBE_BYTES = 32
+
+@dataclass
+class Payload:
+    """
+    What `Steganography.probe` found hidden within an image.
+
+    Args:
+        codec (str): "native" or "stegano".
+        length (int): bytes of the hidden file.
+        format (str | None): extension of the hidden file, None if not an image format we know.
+    """
+    codec: str
+    length: int
+    format: str | None
+
+def _webp(data: Image.Image, profile: Profile, quality: int | None = None,
+          scale: float = 1.0) -> bytes:
+    """`data` as WebP bytes of `profile`, lossy at `quality` if given, resized by `scale`."""
+    if scale < 1:
+        data = data.resize((max(1, round(data.width * scale)), max(1, round(data.height * scale))),
+                           Image.Resampling.LANCZOS)
+    options = save_options("webp", profile)
+    if quality is not None:
+        options.update(quality=quality, lossless=False)
+    buffered = BytesIO()
+    data.save(buffered, **options)
+    return buffered.getvalue()
+
+def _fit(data: Image.Image, capacity: int, max_trials: int, profile: Profile) -> bytes:
+    """
+    Search WebP quality and scale until `data` fits in `capacity` bytes, with at most \
+    `max_trials` encodes: first shrink until the lowest quality fits, then spend what is left \
+    raising the quality back up to the one of `profile`.
+    """
+    payload = _webp(data, profile)
+    trials = 1
+    report("payload", trials / max_trials)
+    if len(payload) <= capacity:
+        return payload
+
+    best: bytes | None = None
+    scale = 1.0
+    while trials < max_trials:
+        payload = _webp(data, profile, _MIN_QUALITY, scale)
+        trials += 1
+        report("payload", trials / max_trials)
+        if len(payload) <= capacity:
+            best = payload
+            break
+        # the size goes roughly with the pixel count, aim a little under.
+        scale *= 0.95 * math.sqrt(capacity / len(payload))
+    if best is None:
+        raise ValueError("payload cannot fit within the cover image")
+
+    low, high = _MIN_QUALITY, profile.webp_quality
+    while trials < max_trials and high - low > 5:
+        quality = (low + high) // 2
+        payload = _webp(data, profile, quality, scale)
+        trials += 1
+        report("payload", trials / max_trials)
+        if len(payload) <= capacity:
+            best, low = payload, quality
+        else:
+            high = quality
+    return best
+
+def _channels(img: Image.Image) -> np.ndarray:
+    """The RGB channels of `img` flattened, alpha (if any) is never touched."""
+    return np.array(img.convert("RGB")).reshape(-1)
+
+def _embed(cover: Image.Image, payload: bytes) -> Image.Image:
+    """Write the header and `payload` into the lowest bit of each RGB channel of `cover`."""
+    header = _HEADER.pack(_MAGIC, _VERSION, len(payload), zlib.crc32(payload))
+    bits = np.unpackbits(np.frombuffer(header + payload, np.uint8))
+
+    channels = _channels(cover)
+    if bits.size > channels.size:
+        raise ValueError("payload is larger than the cover image can hold")
+    channels[:bits.size] = (channels[:bits.size] & 0xFE) | bits
+
+    result = Image.fromarray(channels.reshape(cover.height, cover.width, 3), "RGB")
+    if cover.mode == "RGBA":
+        result.putalpha(cover.getchannel("A"))
+    return result
+
+def _extract(img: Image.Image) -> bytes | None:
+    """Read back what `_embed` wrote, None when `img` carries no native header."""
+    channels = _channels(img)
+    header_bits = _HEADER.size * 8
+    if channels.size < header_bits:
+        return None
+    magic, version, length, checksum = _HEADER.unpack(
+        np.packbits(channels[:header_bits] & 1).tobytes())
+    if magic != _MAGIC or version != _VERSION:
+        return None
+
+    end = header_bits + length * 8
+    if end > channels.size:
+        raise ValueError("payload length exceeds the image")
+    payload = np.packbits(channels[header_bits:end] & 1).tobytes()
+    if zlib.crc32(payload) != checksum:
+        raise ValueError("payload checksum mismatch")
+    return payload
+
+def _cut_tile(img: Image.Image, rows: int):
+    """Have the next `load` of the PNG `img` decode its first `rows` only, rows come in order."""
+    codec, _, offset, args = img.tile[0]
+    img.tile = [(codec, (0, 0, img.width, rows), offset, args)]
+
+@cache
+def _decodes_rows() -> bool:
+    """
+    `_cut_tile` works with the PIL installed: checked once against a full decode, so a PIL \
+    which decodes tiles otherwise makes `_head` decode everything rather than read wrong bits.
+    """
+    buffered = BytesIO()
+    pixels = np.random.default_rng(0).integers(0, 256, (8, 16, 3), np.uint8)
+    Image.fromarray(pixels, "RGB").save(buffered, format="png")
+    try:
+        with Image.open(buffered) as img:
+            _cut_tile(img, 3)
+            img.load()
+            return np.array_equal(np.asarray(img)[:3], pixels[:3])
+    except Exception: # pylint: disable=broad-exception-caught
+        return False
+
+def _head(source: str | os.PathLike | BinaryIO | Image.Image, count: int) -> tuple[bytes, int]:
+    """
+    The lowest bits of the first `count` RGB channels of `source` packed into bytes, and the \
+    number of RGB channels of the whole image. Of a PNG file, only the rows they lie on are decoded.
+    """
+    img = source if isinstance(source, Image.Image) else Image.open(source)
+    channels = img.width * img.height * 3
+    rows = min(img.height, -(-count // (img.width * 3)))
+    if (img is not source and img.format == "PNG" and not img.info.get("interlace")
+            and len(img.tile) == 1 and img.tile[0][0] == "zip" and rows < img.height
+            and _decodes_rows()):
+        _cut_tile(img, rows)
+        img.load()
+    return np.packbits(_channels(img.crop((0, 0, img.width, rows)))[:count] & 1).tobytes(), channels
+
 class Steganography:
     """Encode and decode. [This will be upgraded to prevent computer-lizing]"""
     @classmethod
-    def encode(cls, preview: Image.Image, data: Image.Image, path: str) -> bool:
+    def capacity(cls, preview: Image.Image, codec: str = "native") -> int:
+        """
+        Bytes of WebP `preview` can hold, known before encoding anything.
+
+        Args:
+            preview (Image.Image): Preview image.
+            codec (str): "native" or "stegano".
+
+        Returns:
+            int: the capacity in bytes.
+        """
+        assert codec in CODECS, f"Invalid codec (should be one of {CODECS})."
+        budget = preview.width * preview.height * 3 // 8 # one bit per RGB channel.
+        if codec == "native":
+            return max(0, budget - _HEADER.size)
+        # stegano writes "<length>:" then base85, 5 characters for 4 bytes.
+        return max(0, (budget - len(str(budget)) - 1) * 4 // 5)
+
+    @classmethod
+    def probe(cls, source: str | os.PathLike | BinaryIO | Image.Image) -> Payload | None:
+        """
+        Tell whether something is hidden within `source` from the first bytes of embedded data \
+        only, in milliseconds where `reveal` needs the whole image. The checksum is left to \
+        `reveal`, a damaged payload still passes.
+
+        Args:
+            source (str | os.PathLike | BinaryIO | Image.Image): a path, a file object or an \
+                image. Opened here, a PNG is decoded only as far as the embedded header.
+
+        Returns:
+            Payload | None: what is hidden, None when nothing is (or not an image at all).
+        """
+        with stage("probe"):
+            try:
+                head, channels = _head(source, _PROBE_BYTES * 8)
+            except (OSError, ValueError): # not an image, or a truncated one.
+                return None
+            budget = channels // 8
+
+            if len(head) >= _HEADER.size:
+                magic, version, length, _ = _HEADER.unpack_from(head)
+                if magic == _MAGIC and version == _VERSION:
+                    if _HEADER.size + length > budget:
+                        return None
+                    return Payload("native", length, sniff_format(head[_HEADER.size:]))
+
+            # stegano writes "<length>:" then the payload as base85.
+            digits, colon, text = head.partition(b":")
+            if not colon or not digits.isdigit() or len(digits) + 1 + int(digits) > budget:
+                return None
+            text = text[:int(digits)]
+            try:
+                start = b85decode(text[:len(text) // 5 * 5])
+            except ValueError: # not our base85, `reveal` would fail as well.
+                return None
+            return Payload("stegano", int(digits) * 4 // 5, sniff_format(start))
+
+    @classmethod
+    def payload_size(cls, data: Image.Image, profile: str | Profile = DEFAULT_PROFILE) -> int:
+        """
+        Bytes `data` takes once encoded as WebP, compare it with `Steganography.capacity` \
+        before hiding.
+
+        Args:
+            data (Image.Image): The real image that got hidden.
+            profile (str | Profile): codec profile of the WebP payload.
+
+        Returns:
+            int: the payload size in bytes.
+        """
+        return len(_webp(data, get_profile(profile)))
+
+    @classmethod
+    def hide(cls, preview: Image.Image, data: Image.Image, codec: str = "native",
+             fit: bool = False, max_trials: int = 8,
+             profile: str | Profile = DEFAULT_PROFILE) -> Image.Image:
+        """
+        Hide `data` within `preview`, without saving. The capacity is checked before \
+        embedding, so nothing is wasted on a payload that does not fit.
+
+        Args:
+            preview (Image.Image): Preview image.
+            data (Image.Image): The real image that got hidden.
+            codec (str): "native" packs the raw bytes with numpy, "stegano" is the older \
+                base85 + `stegano.lsb` format.
+            fit (bool): if the payload is too large, lower the WebP quality and then the \
+                scale of `data` until it fits.
+            max_trials (int): WebP encodes allowed while fitting.
+            profile (str | Profile): codec profile of the WebP payload, see `profiles`.
+
+        Raises:
+            ValueError: `data` does not fit within `preview`.
+
+        Returns:
+            Image.Image: the encoded image.
+        """
+        assert codec in CODECS, f"Invalid codec (should be one of {CODECS})."
+        capacity = cls.capacity(preview, codec)
+        profile = get_profile(profile)
+        report("payload", 0)
+        with stage("payload"):
+            if fit:
+                payload = _fit(data, capacity, max_trials, profile)
+            else:
+                payload = _webp(data, profile)
+        if len(payload) > capacity:
+            raise ValueError("payload is larger than the cover image can hold")
+        report("embed", 0)
+        with stage("embed"):
+            if codec == "native":
+                return _embed(preview, payload)
+            return stegano.lsb.hide(preview, b85encode(payload).decode())
+
+    @classmethod
+    def reveal(cls, decoded_image: Image.Image) -> Image.Image:
+        """
+        Reveal the image hidden within `decoded_image`, without saving. Images without the \
+        native header are handed to `stegano`, so the ones encoded before still open.
+
+        Args:
+            decoded_image (Image.Image): Decoded image.
+
+        Raises:
+            ValueError: nothing readable is hidden.
+
+        Returns:
+            Image.Image: the hidden image.
+        """
+        with stage("extract"):
+            payload = _extract(decoded_image)
+            if payload is None:
+                hidden = stegano.lsb.reveal(decoded_image)
+                if hidden is None:
+                    raise ValueError("Nothing is hidden within the image.")
+                payload = b85decode(hidden)
+        return Image.open(BytesIO(payload))
+
+    @classmethod
+    def encode_preview(cls, source: Source, intensity: float, path: str, seed: int | None = None,
+                       codec: str = "native", fit: bool = True, max_trials: int = 8,
+                       profile: str | Profile = DEFAULT_PROFILE,
+                       pixel_sum: int | None = None) -> bool:
+        """
+        Create the preview of `source` and hide `source` within it in one go. The source is \
+        decoded once, its pixels go to the preview and to the payload straight from memory, and \
+        only the result is written.
+
+        Args:
+            source (Source): the real image, anything `Generator` reads.
+            intensity (float): intensity of the preview (0-1).
+            path (str): The path the encoded preview is saved into.
+            seed (int | None): seed of the preview.
+            codec (str): "native" or "stegano".
+            fit (bool): shrink the payload until it fits, see `Steganography.hide`.
+            max_trials (int): WebP encodes allowed while fitting.
+            profile (str | Profile): codec profile of the payload and of the saved file.
+            pixel_sum (int | None): sum of the pixels of `source` if known, see `Generator`.
+
+        Returns:
+            bool: operate successfully.
+        """
+        generator = Generator(source, seed=seed, pixel_sum=pixel_sum)
+        preview = generator.preview(intensity)
+        return cls.encode(preview, Image.fromarray(generator.img_data, "RGB"), path, codec, fit,
+                          max_trials, profile)
+
+    @classmethod
+    def encode(cls, preview: Image.Image, data: Image.Image, path: str,
+               codec: str = "native", fit: bool = False, max_trials: int = 8,
+               profile: str | Profile = DEFAULT_PROFILE) -> bool:
         """
         Encoder.
 
@@ -20,33 +357,37 @@ class Steganography:
             preview (Image.Image): Preview image.
             data (Image.Image): The real image that got hidden.
             path (str): The path the encoded image is saved into.
+            codec (str): "native" packs the raw bytes with numpy, "stegano" is the older \
+                base85 + `stegano.lsb` format.
+            fit (bool): shrink the payload until it fits, see `Steganography.hide`.
+            max_trials (int): WebP encodes allowed while fitting.
+            profile (str | Profile): codec profile of the payload and of the saved file.
 
         Returns:
             bool: operate successfully.
         """
         try:
-            buffered = BytesIO()
-            data.save(buffered, format="webp")
-            encoded_data = b85encode(buffered.getvalue()).decode()
-            stegano.lsb.hide(preview, encoded_data).save(path)
+            save(cls.hide(preview, data, codec, fit, max_trials, profile), path, profile)
             return True
         except (ValueError, TypeError):
             return False
 
     @classmethod
-    def decode(cls, decoded_image: Image.Image, path: str) -> bool:
+    def decode(cls, decoded_image: Image.Image, path: str,
+               profile: str | Profile = DEFAULT_PROFILE) -> bool:
         """
         Decoder.
 
         Args:
             decoded_image (Image.Image): Decoded image.
             path (str): The path then hidden image is saved into.
-        
+            profile (str | Profile): codec profile of the saved file.
+
         Returns:
             bool: operate successfully.
         """
         try:
-            Image.open(BytesIO(b85decode(stegano.lsb.reveal(decoded_image)))).save(path)
+            save(cls.reveal(decoded_image), path, profile)
             return True
         except (ValueError, TypeError):
             return False
@@ -0,0 +1,184 @@
+# cspell:ignore multipart
+"""
+Receive uploads straight to disk, checking their size and format while they arrive.
+"""
+
+import os
+import uuid
+import asyncio
+import hashlib
+from dataclasses import dataclass, field
+
+from fastapi import Request
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from .formats import SNIFF_BYTES, sniff_format
+
+# written to disk in batches of this many bytes, not once per received chunk.
+_WRITE_SIZE = 1 << 20
+# text fields are small, anything bigger is not from our form.
+_MAX_FIELD_SIZE = 1 << 16
+
+class UploadError(ValueError):
+    """The upload is refused, the message is meant for the user."""
+
+@dataclass
+class Upload:
+    """
+    A received upload.
+
+    Args:
+        filename (str): name of the saved file, with the extension of its real format.
+        size (int): bytes received.
+        digest (str): sha256 of the content.
+        fields (dict[str, str]): the other form fields.
+    """
+    filename: str
+    size: int
+    digest: str
+    fields: dict[str, str] = field(default_factory=dict)
+
+class _Receiver:
+    """State of one upload, fed by the multipart parser callbacks."""
+    def __init__(self, directory: str, file_field: str, max_bytes: int):
+        self.directory = directory
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.fields: dict[str, str] = {}
+        self.size: int = 0
+        self.ext: str | None = None
+        self.path = os.path.join(directory, f"{uuid.uuid4().hex}.part")
+        self.digest = hashlib.sha256()
+        self.pending: list[bytes] = []
+        self.pending_size: int = 0
+        self.file = None
+
+        self._header_field = b""
+        self._header_value = b""
+        self._name: str | None = None
+        self._is_file = False
+        self._value = bytearray()
+
+    def callbacks(self) -> dict:
+        """Callbacks for `MultipartParser`."""
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        }
+
+    def _on_part_begin(self):
+        self._name, self._is_file = None, False
+        self._value.clear()
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            _, options = parse_options_header(self._header_value)
+            self._name = options.get(b"name", b"").decode("latin-1")
+            self._is_file = b"filename" in options
+        self._header_field, self._header_value = b"", b""
+
+    def _on_headers_finished(self):
+        if self._is_file and self._name != self.file_field:
+            raise UploadError("Unable to load form.")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if not self._is_file:
+            self._value += data[start:end]
+            if len(self._value) > _MAX_FIELD_SIZE:
+                raise UploadError("Unable to load form.")
+            return
+
+        # Im poor u know lol. You can raise the limit, just acknowledge your cpu power.
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise UploadError(f"File should be <{self.max_bytes / 1_073_741_824:g}GB.")
+        self.pending.append(data[start:end])
+        self.pending_size += end - start
+
+        if self.ext is None and self.size >= SNIFF_BYTES:
+            self.ext = sniff_format(b"".join(self.pending)[:SNIFF_BYTES])
+            if self.ext is None:
+                raise UploadError("Unsupported file type.")
+
+    def _on_part_end(self):
+        if not self._is_file and self._name:
+            self.fields[self._name] = self._value.decode()
+
+    def flush(self):
+        """Write and hash what was received so far, run it off the event loop."""
+        if self.file is None:
+            self.file = open(self.path, "wb") # pylint: disable=consider-using-with
+        data = b"".join(self.pending)
+        self.pending.clear()
+        self.pending_size = 0
+        self.digest.update(data)
+        self.file.write(data)
+
+    def close(self, keep: bool):
+        """Close the file, then give it its final name or delete it."""
+        if self.file is not None:
+            self.file.close()
+        if not keep:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        os.replace(self.path, self.path.removesuffix(".part") + self.ext)
+
+async def receive_upload(request: Request, directory: str, max_bytes: int,
+                         file_field: str = "file") -> Upload:
+    """
+    Receive a multipart upload chunk by chunk into `directory`. The body is never held \
+    whole, disk writes and hashing run on a thread, and the upload stops as soon as it is too \
+    large or does not start like an image.
+
+    Args:
+        request (Request): the request.
+        directory (str): where the file is saved.
+        max_bytes (int): largest file accepted.
+        file_field (str): name of the file field.
+
+    Raises:
+        UploadError: the upload is refused.
+
+    Returns:
+        Upload: the received upload.
+    """
+    if int(request.headers.get("content-length") or 0) > max_bytes + _MAX_FIELD_SIZE:
+        raise UploadError(f"File should be <{max_bytes / 1_073_741_824:g}GB.")
+    _, options = parse_options_header(request.headers.get("content-type", ""))
+    if b"boundary" not in options:
+        raise UploadError("Unable to load form.")
+
+    receiver = _Receiver(directory, file_field, max_bytes)
+    parser = MultipartParser(options[b"boundary"], receiver.callbacks())
+    keep = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if receiver.pending_size >= _WRITE_SIZE:
+                await asyncio.to_thread(receiver.flush)
+        parser.finalize()
+        if receiver.ext is None:
+            raise UploadError("Unable to load form." if receiver.size == 0 else
+                              "Unsupported file type.")
+        await asyncio.to_thread(receiver.flush)
+        keep = True
+    except MultipartParseError as err:
+        raise UploadError("Unable to load form.") from err
+    finally:
+        await asyncio.to_thread(receiver.close, keep)
+
+    return Upload(os.path.basename(receiver.path.removesuffix(".part") + receiver.ext),
+                  receiver.size, receiver.digest.hexdigest(), receiver.fields)
@@ -1,70 +1,380 @@
 #cSpell:ignore stegano
 """Website with fastapi"""
-import shutil
 import uuid
 import os
-import time
+import math
 import json
+import time
 import asyncio
-from concurrent.futures.thread import ThreadPoolExecutor
+import logging
+import contextvars
 from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
 
-from fastapi import FastAPI, Request
+from fastapi import APIRouter, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse,
+                               StreamingResponse)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from PIL import Image
-
-from . import Generator, Steganography
+from .animation import DEFAULT_FRAME_WORKERS
+from .cache import ResultCache, hash_file
+from .jobs import (Admission, JobExecutor, QueueFullError, create_executor, decode_job,
+                   encode_job, preview_encode_job, preview_job, preview_many_job)
+from .metrics import CONTENT_TYPE, METRICS, collect, record_all, server_timing, stage
+from .profiles import get_profile
+from .registry import FINISHED, Job, JobRegistry, MemoryJobRegistry, create_registry
+from .scheduler import estimate_cost, image_pixels
+from .upload import UploadError, receive_upload
+from .settings import Settings
+from .sources import SOURCES
+from .steganography import Steganography
 
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 IMAGE_DIR = os.path.join(PROJECT_ROOT, "static", "images")
-os.makedirs(IMAGE_DIR, exist_ok=True)
 
+# nothing below touches the disk or starts a worker, `create_app` does.
+router = APIRouter()
+templates = Jinja2Templates(directory=os.path.join(PROJECT_ROOT, "templates"))
+
+@dataclass
+class Services:
+    """
+    What the handlers share, built by `create_app` and kept in `app.state.services`.
+
+    Args:
+        settings (Settings): the settings.
+        executor (JobExecutor): where the heavy jobs run.
+        cache (ResultCache): finished results.
+        registry (JobRegistry): the jobs.
+        tasks (set[asyncio.Task]): jobs running in the background.
+    """
+    settings: Settings
+    executor: JobExecutor
+    cache: ResultCache
+    registry: JobRegistry
+    tasks: set[asyncio.Task] = field(default_factory=set)
+
+def _services(request: Request) -> Services:
+    return request.app.state.services
+
+_REQUESTS = METRICS.counter("qp_requests_total", "Requests answered, by route and status.")
+_REQUEST_SECONDS = METRICS.histogram("qp_request_seconds", "Seconds to answer, by route.")
+_IN_FLIGHT = METRICS.gauge("qp_requests_in_flight", "Requests being answered.")
+_JOBS = METRICS.counter("qp_jobs_total", "Jobs finished, by status.")
+_CACHE = METRICS.counter("qp_cache_requests_total", "Result cache lookups, by result.")
+
+class MetricsMiddleware:
+    """
+    Count and time every HTTP request, and gather the stages timed while answering it. Pure \
+    ASGI, so it costs a few dict updates per request.
+    """
+    def __init__(self, app, server_timing_header: bool = False):
+        self.app = app
+        self.server_timing_header = server_timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing_header and timings:
+                    message["headers"] = [*message.get("headers", []), (
+                        b"server-timing", server_timing(timings).encode("latin-1"))]
+            await send(message)
+
+        _IN_FLIGHT.inc()
+        try:
+            with collect() as timings:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            _IN_FLIGHT.dec()
+            # the template of the route, not the path, so the labels stay few.
+            route = getattr(scope.get("route"), "path", "other")
+            _REQUESTS.inc(route=route, method=scope["method"], status=str(status))
+            _REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+            record_all(timings)
+
+def _remove_files(*names: str):
+    for name in names:
+        path = os.path.join(IMAGE_DIR, name)
+        SOURCES.invalidate(path)
+        if os.path.exists(path):
+            os.remove(path)
+
+def _remove_stale_files(ttl: float):
+    """
+    Delete the files older than `ttl` the registry does not know of: uploads cut short (".part"), \
+    files of a worker whose memory registry was lost with it.
+    """
+    now = time.time()
+    with os.scandir(IMAGE_DIR) as scanned:
+        for item in scanned:
+            try:
+                if item.is_file() and now - item.stat().st_mtime > ttl:
+                    _remove_files(item.name)
+            except FileNotFoundError: # removed by another worker meanwhile.
+                pass
 
-async def cleanup_worker():
+async def cleanup_worker(services: Services):
     """For every 1 hour, delete uploaded files with lifespan of 1 hour. This prevent everything."""
     try:
         while True:
-            try:
-                for name in os.listdir(IMAGE_DIR):
-                    path = os.path.join(IMAGE_DIR, name)
-                    if time.time() - os.path.getmtime(path) > 3600:
-                        os.remove(path)
-            except FileNotFoundError:
-                pass
+            expired = await asyncio.to_thread(services.registry.expired)
+            for job in expired:
+                _remove_files(*job.outputs)
+                if job.status == "uploaded":
+                    _remove_files(job.owner)
+            await asyncio.to_thread(services.registry.delete, [job.uid for job in expired])
+            await asyncio.to_thread(_remove_stale_files, services.settings.job_ttl)
             await asyncio.sleep(3600)
     except asyncio.CancelledError:
         return
 
+async def cancel_worker(services: Services):
+    """Cancel the jobs of this worker that were cancelled through the registry by any worker."""
+    try:
+        while True:
+            for uid in await asyncio.to_thread(services.registry.cancelling):
+                services.executor.cancel(uid)
+            await asyncio.sleep(1)
+    except asyncio.CancelledError:
+        return
+
 @asynccontextmanager
-async def lifespan(_app: FastAPI):
+async def lifespan(app: FastAPI):
     """Lifespan of the app, on event startup and shutdown."""
+    services: Services = app.state.services
     # startup event.
-    asyncio.create_task(cleanup_worker())
+    asyncio.create_task(cleanup_worker(services))
+    asyncio.create_task(cancel_worker(services))
     yield
     # Shutdown event.
-    executor.shutdown(cancel_futures=True)
-    for name in os.listdir(IMAGE_DIR):
-        path = os.path.join(IMAGE_DIR, name)
-        os.remove(path)
-
-app = FastAPI(lifespan=lifespan)
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_methods=["POST"],
-    max_age=100,
-)
-app.mount("/static", StaticFiles(directory=os.path.join(PROJECT_ROOT, "static")), name="static")
-templates = Jinja2Templates(directory=os.path.join(PROJECT_ROOT, "templates"))
-executor = ThreadPoolExecutor()
-background_task: dict = {}
-
-def _remove_from_list(uid: str):
-    background_task.pop(uid, None)
+    for task in list(services.tasks):
+        task.cancel()
+    services.executor.shutdown()
+    # the files of the jobs this worker alone knows of, those of a shared registry are left to
+    # the other workers and their `cleanup_worker`.
+    if isinstance(services.registry, MemoryJobRegistry):
+        for job in services.registry.expired(math.inf):
+            _remove_files(job.owner, *job.outputs)
+    services.registry.close()
+    SOURCES.clear()
+
+def create_app(settings: Settings | None = None) -> FastAPI:
+    """
+    Build the app, with its workers, cache and registry.
+    ```
+    uvicorn --factory src.web:create_app
+    ```
+
+    Args:
+        settings (Settings | None): the settings, None to read them from the environment.
+
+    Returns:
+        FastAPI: the app.
+    """
+    settings = Settings.from_env() if settings is None else settings
+    get_profile(settings.codec_profile) # refuse an unknown profile at startup, not per request.
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_methods=["POST"],
+        max_age=100,
+    )
+    app.add_middleware(MetricsMiddleware, server_timing_header=settings.server_timing)
+    app.mount("/static", StaticFiles(directory=os.path.join(PROJECT_ROOT, "static")),
+              name="static")
+    app.include_router(router)
+    app.state.services = Services(
+        settings,
+        create_executor(settings.executor, settings.workers, settings.max_queue,
+                        settings.cost_budget, settings.max_delay, settings.source_cache_bytes),
+        ResultCache(settings.cache_dir or os.path.join(PROJECT_ROOT, "cache"),
+                    settings.cache_max_bytes),
+        create_registry(settings.registry,
+                        settings.registry_path or os.path.join(PROJECT_ROOT, "jobs.sqlite3"),
+                        settings.job_ttl))
+    executor = app.state.services.executor
+    METRICS.gauge("qp_jobs_running", "Jobs running on a worker.", lambda: executor.running)
+    METRICS.gauge("qp_jobs_waiting", "Jobs waiting for a worker.",
+                  lambda: executor.outstanding - executor.running)
+    METRICS.gauge("qp_jobs_outstanding_cost_seconds",
+                  "Estimated seconds of one core of the jobs running or waiting.",
+                  lambda: executor.outstanding_cost)
+    METRICS.gauge("qp_cost_budget_seconds", "Budget of the outstanding cost, 0 for none.",
+                  lambda: executor.max_cost)
+    METRICS.gauge("qp_source_cache_bytes",
+                  "Bytes of decoded uploads kept in memory by the web process (thread executor).",
+                  lambda: SOURCES.size)
+    return app
+
+_app: FastAPI | None = None
+
+def __getattr__(name: str):
+    # `app` is built on first use, so importing this module stays free of side effects.
+    global _app # pylint: disable=global-statement
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _busy(template: str, context: dict):
+    """Tell the client every worker is taken and when to come back."""
+    retry_after = _services(context["request"]).settings.retry_after
+    return templates.TemplateResponse(template, context | {
+        "error": "The server is busy right now, please try again in a moment."},
+        status_code=503, headers={"Retry-After": str(retry_after)})
+
+async def _digest(services: Services, img: str) -> str:
+    """sha256 of the upload `img`, as computed while it was received."""
+    for job in await asyncio.to_thread(services.registry.of_owner, img):
+        if job.status == "uploaded" and job.digest:
+            return job.digest
+    return await asyncio.to_thread(hash_file, os.path.join(IMAGE_DIR, img))
+
+async def _create_job(services: Services, owner: str, *outputs: str) -> str:
+    """Register a job of the upload `owner` which saves `outputs`, return its id."""
+    uid: str = uuid.uuid4().hex
+    await asyncio.to_thread(services.registry.create, uid, owner)
+    for output in outputs:
+        await asyncio.to_thread(services.registry.add_output, uid, output)
+    return uid
+
+def _client(request: Request) -> str:
+    """Who sent `request`, the clients take turns for the workers."""
+    header = _services(request).settings.client_header
+    if header and request.headers.get(header):
+        return request.headers[header].split(",")[0].strip()
+    return request.client.host if request.client else ""
+
+async def _cost(operation: str, img: str, intensity: float = 1.0, count: int = 1) -> float:
+    """`scheduler.estimate_cost` of a job on the upload `img`, its size read from the header."""
+    pixels = await asyncio.to_thread(image_pixels, os.path.join(IMAGE_DIR, img))
+    return estimate_cost(operation, pixels, intensity, count)
+
+async def _run_job(services: Services, uid: str, output: str, key: str | None, fn,
+                   *args, cost: float = 0.0, client: str = "", source: str | None = None,
+                   admission: Admission | None = None) -> bool:
+    """
+    Run `fn(*args)` as the job `uid`, which saves `output`, and keep the registry up to date, \
+    progress included. With a `key`, the result is copied from the cache when there is one. \
+    The `cost`, `client`, `source` and `admission` go to the executor, see `JobExecutor.run`. \
+    The progress is written off the event loop, one write at a time with the latest report.
+    """
+    output_path = os.path.join(IMAGE_DIR, output)
+    latest: list[tuple[str, float]] = [] # the report waiting to be written, if any.
+    writer: asyncio.Task | None = None
+
+    async def write_progress():
+        while latest:
+            await asyncio.to_thread(services.registry.set_progress, uid, *latest.pop())
+
+    def on_progress(stage_name: str, progress: float):
+        nonlocal writer
+        latest[:] = [(stage_name, progress)]
+        if writer is None or writer.done():
+            writer = asyncio.create_task(write_progress())
+
+    async def set_status(status: str):
+        if writer is not None: # so the last report does not land after the final status.
+            await asyncio.gather(writer, return_exceptions=True)
+        await asyncio.to_thread(services.registry.set_status, uid, status)
+    try:
+        with stage("cache"):
+            cached = bool(key) and await asyncio.to_thread(services.cache.get, key, output_path)
+        if key:
+            _CACHE.inc(result="hit" if cached else "miss")
+        if cached:
+            succeeded = True
+        else:
+            await set_status("running")
+            succeeded = await services.executor.run(uid, fn, *args, on_progress=on_progress,
+                                                    cost=cost, client=client, source=source,
+                                                    admission=admission)
+            if key and succeeded:
+                await asyncio.to_thread(services.cache.put, key, output_path)
+    except asyncio.exceptions.CancelledError:
+        _JOBS.inc(status="cancelled")
+        await asyncio.shield(set_status("cancelled"))
+        raise
+    except BaseException:
+        _JOBS.inc(status="failed")
+        await asyncio.shield(set_status("failed"))
+        raise
+    await set_status("done" if succeeded else "failed")
+    _JOBS.inc(status="done" if succeeded else "failed")
+    return succeeded
+
+async def _start_job(services: Services, owner: str, output: str, key: str | None, fn, *args,
+                     cost: float = 0.0, client: str = "", source: str | None = None,
+                     extra_outputs: tuple[str, ...] = ()) -> str:
+    """
+    Start `_run_job` in the background, return the id of the job. Its place is taken before \
+    answering, so a burst of requests cannot all get in. The `extra_outputs` the job saves \
+    besides `output` are registered before it starts, so its result lists all of them.
+
+    Raises:
+        QueueFullError: no room for another job (or for its cost), checked before anything is \
+            registered.
+    """
+    admission = services.executor.admit(cost)
+    try:
+        uid = await _create_job(services, owner, output, *extra_outputs)
+    except BaseException:
+        services.executor.release(admission)
+        raise
+
+    async def run():
+        try:
+            await _run_job(services, uid, output, key, fn, *args, cost=cost, client=client,
+                           source=source, admission=admission)
+        except asyncio.CancelledError:
+            pass # the registry already tells.
+        except Exception: # pylint: disable=broad-exception-caught
+            logging.exception("Job %s failed.", uid)
+        finally: # a cached result never reached the executor.
+            services.executor.release(admission)
+
+    # a context of its own, so the stages of the job go to the histograms, not to the
+    # `collect()` of the request which answered long before.
+    task = asyncio.create_task(run(), context=contextvars.Context())
+    services.tasks.add(task) # a task nobody refers to can be garbage collected.
+    task.add_done_callback(services.tasks.discard)
+    return uid
+
+# intensities of a preview sweep when none are asked, and the most allowed in one.
+_SWEEP = tuple(round(0.1 * step, 1) for step in range(1, 11))
+_MAX_SWEEP = 32
+
+# the answer to an upload which carries nothing to decode.
+_NOTHING_HIDDEN = ("Nothing is hidden within this image. Decode the image the encoder saved, "
+                   "as it was downloaded (a resized or re-compressed copy loses what it hides).")
+
+async def _probe(img: str):
+    """`Steganography.probe` of the upload `img`, off the event loop."""
+    return await asyncio.to_thread(Steganography.probe, os.path.join(IMAGE_DIR, img))
+
+def _job_state(job: Job) -> dict:
+    state = {"job": job.uid, "status": job.status, "stage": job.stage,
+             "progress": 1.0 if job.status == "done" else job.progress}
+    if job.status == "done" and job.outputs:
+        state["url"] = f"/static/images/{job.outputs[0]}"
+        if len(job.outputs) > 1:
+            state["urls"] = [f"/static/images/{output}" for output in job.outputs]
+    return state
 
 
 
@@ -72,37 +382,38 @@ def _remove_from_list(uid: str):
 
 
 
-@app.get("/", response_class=HTMLResponse)
+@router.get("/", response_class=HTMLResponse)
 async def start(request: Request):
     """A default start on app."""
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.post("/", response_class=RedirectResponse)
+@router.post("/", response_class=RedirectResponse)
 async def upload(request: Request):
     """Upload the file, then encode or decode depend on selection."""
-    form = await request.form()
-    file = form.get("file")
-
-    if not file or not form.get("upload_type"):
+    services = _services(request)
+    try:
+        with stage("upload"):
+            uploaded = await receive_upload(request, IMAGE_DIR,
+                                            services.settings.max_upload_bytes)
+    except UploadError as err:
+        return templates.TemplateResponse("index.html", {"request": request, "error": str(err)})
+
+    upload_type = uploaded.fields.get("upload_type")
+    if upload_type not in ("encode", "decode"):
+        _remove_files(uploaded.filename)
         return templates.TemplateResponse("index.html",
                                           {"request": request, "error": "Unable to load form."})
-
-    # Im poor u know lol. You can delete this line, just acknowledge your cpu power.
-    if file.size > 1_073_741_824:
-        return templates.TemplateResponse("index.html",
-                                          {"request": request, "error": "File should be <1GB."})
-    _, ext = os.path.splitext(file.filename)
-    if ext.lower() not in (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"):
+    # refused here, before a decode job ever waits for a worker.
+    if upload_type == "decode" and await _probe(uploaded.filename) is None:
+        _remove_files(uploaded.filename)
         return templates.TemplateResponse("index.html",
-                                          {"request": request, "error": "Unsupported file type."})
-
-    filename = f"{uuid.uuid4().hex}{ext}"
-    with open(os.path.join(IMAGE_DIR, filename), "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+                                          {"request": request, "error": _NOTHING_HIDDEN})
 
-    return RedirectResponse(f"/{form.get("upload_type")}/{filename}", status_code=303)
+    await asyncio.to_thread(services.registry.create, uuid.uuid4().hex, uploaded.filename,
+                            "uploaded", uploaded.digest)
+    return RedirectResponse(f"/{upload_type}/{uploaded.filename}", status_code=303)
 
-@app.get("/encode/{img}", response_class=HTMLResponse)
+@router.get("/encode/{img}", response_class=HTMLResponse)
 async def start_encode(request: Request, img: str):
     """Start the encode html."""
     if not os.path.exists(os.path.join(IMAGE_DIR, img)):
@@ -111,90 +422,130 @@ async def start_encode(request: Request, img: str):
                 "If it continues to happen, install the local version.")})
     return templates.TemplateResponse("encode.html", {"request": request, "filename": img})
 
-@app.post("/encode/{img}", response_class=HTMLResponse)
+@router.post("/encode/{img}", response_class=HTMLResponse)
 async def end_encode(request: Request, img: str):
-    """This guy here gonna cook us dinner."""
+    """
+    This guy here gonna cook us dinner. With the form field `async=1` the job runs in the \
+    background, the answer is its id right away and `/jobs/{uid}/events` tells how it goes.
+    """
     if not os.path.exists(os.path.join(IMAGE_DIR, img)):
         return """<h2>INTERNAL ERROR</h2><p>The image file cannot be found, please restart the \
 system. If it continues to happen, install the local version.</p>"""
 
+    services = _services(request)
+    profile = services.settings.codec_profile
     form = await request.form()
+    save_path = form.get("save_path")
     input_path = os.path.join(IMAGE_DIR, img)
-    output_path = os.path.join(IMAGE_DIR, form.get("save_path"))
+    output_path = os.path.join(IMAGE_DIR, save_path or "")
+    # the format of the result, a cached PNG is no GIF.
+    extension = os.path.splitext(save_path or "")[1].lower()
 
-    json_path = os.path.join(IMAGE_DIR, f"{os.path.splitext(img)[0]}.json")
-
-    generator = Generator(input_path)
     match form.get("selected"):
-        case "panel_preview":
-            if input_path and form.get("intensity") and form.get("save_path"):
-                try:
-                    uid: str = uuid.uuid4().hex
-                    future_item = asyncio.get_event_loop().run_in_executor(
-                        executor, generator.preview, float(form.get("intensity")))
-                    future_item.add_done_callback(lambda _: _remove_from_list(uid))
-                    background_task.update({uid: future_item})
-
-                    json_data: dict = {}
-                    if os.path.exists(json_path):
-                        json_data = json.load(open(json_path, "rt", encoding="utf-8"))
-                    json_data.update({"uid": uid})
-                    with open(json_path, "wt", encoding="utf-8") as f:
-                        json.dump(json_data, f)
-                        f.close()
-
-                    preview_img = await future_item
-                except asyncio.exceptions.CancelledError:
-                    return templates.TemplateResponse("encode.html",
-                            {"request": request, "filename": img, "error": "User exited."})
-                except AssertionError as err:
-                    return templates.TemplateResponse("encode.html",
-                                                {"request": request, "filename": img, "error": err})
-                preview_img.save(output_path)
-
-                with open(json_path, "wt", encoding="utf-8") as f:
-                    json_data.update({"preview": form.get("save_path")})
-                    json.dump(json_data, f)
-                    f.close()
-                return templates.TemplateResponse("encode_panel.html",
-                    {"request": request, "filename": form.get("save_path"), "img_name": "preview"})
-
-        case "panel_steganography":
-            if input_path and form.get("disguise") and form.get("save_path"):
-                uid: str = uuid.uuid4().hex
-                future_item=asyncio.get_event_loop().run_in_executor(executor, Steganography.encode,
-                    Image.open(form.get("disguise").file), Image.open(input_path), output_path)
-                future_item.add_done_callback(lambda _: _remove_from_list(uid))
-                background_task.update({uid: future_item})
-
-                json_data: dict = {}
-                if os.path.exists(json_path):
-                    json_data = json.load(open(json_path, "rt", encoding="utf-8"))
-                json_data.update({"uid": uid})
-                with open(json_path, "wt", encoding="utf-8") as f:
-                    json.dump(json_data, f)
-                    f.close()
-
-                try:
-                    if await future_item:
-                        with open(json_path, "wt", encoding="utf-8") as f:
-                            json_data.update({"steganography": form.get("save_path")})
-                            json.dump(json_data, f)
-                            f.close()
-                        return templates.TemplateResponse("encode_panel.html", {"request": request,
-                                "filename": form.get("save_path"), "img_name": "stegano"})
-                except asyncio.exceptions.CancelledError:
-                    return templates.TemplateResponse("encode.html",
-                            {"request": request, "filename": img, "error": "User exited."})
+        case "panel_preview" if form.get("intensity") and save_path:
+            try:
+                intensity = float(form.get("intensity"))
+                seed = int(form.get("seed")) if form.get("seed") else None
+                assert 0 <= intensity <= 1, "Invalid intensity"
+            except (ValueError, AssertionError) as err:
                 return templates.TemplateResponse("encode.html",
-                    {"request": request, "filename": img, "error": (
-                        "Cannot encode the image within. Try to decrease the size of real image "
-                        "size or increase the size of the disguise image.")})
+                                            {"request": request, "filename": img, "error": err})
+            # the combined job hides the original within the preview, same single pass.
+            operation = "preview_steganography" if form.get("hide") else "preview"
+            key = ResultCache.key(operation, await _digest(services, img), intensity, seed,
+                                  profile, extension)
+            work = ((key, preview_encode_job, input_path, intensity, output_path, seed, profile)
+                    if form.get("hide") else
+                    (key, preview_job, input_path, intensity, output_path, seed, profile,
+                     services.settings.frame_workers
+                     or min(DEFAULT_FRAME_WORKERS,
+                            max(2, (os.cpu_count() or 1) // services.executor.workers))))
+            cost = await _cost(operation, img, intensity)
+            img_name, failure = "preview", "Cannot encode the image within."
+
+        case "panel_steganography" if form.get("disguise") and save_path:
+            disguise = await form.get("disguise").read()
+            key = ResultCache.key("steganography", await _digest(services, img), disguise,
+                                  profile, extension)
+            work = (key, encode_job, disguise, input_path, output_path, profile)
+            cost = await _cost("steganography", img)
+            img_name, failure = "stegano", (
+                "Cannot encode the image within. Try to decrease the size of real image "
+                "size or increase the size of the disguise image.")
+
+        case _:
+            return templates.TemplateResponse("encode.html",
+                        {"request": request, "filename": img, "error": "Unable to load form."})
 
+    try:
+        if form.get("async") == "1":
+            uid = await _start_job(services, img, save_path, *work, cost=cost,
+                                   client=_client(request), source=input_path)
+            return JSONResponse({"job": uid, "events": f"/jobs/{uid}/events"}, status_code=202)
+        succeeded = await _run_job(services, await _create_job(services, img, save_path),
+                                   save_path, *work, cost=cost, client=_client(request),
+                                   source=input_path)
+    except QueueFullError:
+        return _busy("encode.html", {"request": request, "filename": img})
+    except asyncio.exceptions.CancelledError:
+        return templates.TemplateResponse("encode.html",
+                {"request": request, "filename": img, "error": "User exited."})
+    except AssertionError as err:
+        return templates.TemplateResponse("encode.html",
+                                    {"request": request, "filename": img, "error": err})
+    if succeeded:
+        return templates.TemplateResponse("encode_panel.html",
+                {"request": request, "filename": save_path, "img_name": img_name})
     return templates.TemplateResponse("encode.html",
-                        {"request": request, "filename": img, "error": "Unable to load form."})
+                                {"request": request, "filename": img, "error": failure})
+
+@router.post("/preview/{img}")
+async def preview_sweep(request: Request, img: str):
+    """
+    The previews of `img` at several intensities in one job, for a slider. Form fields: \
+    `intensities` comma separated (0.1 to 1 by 0.1 if not given), `seed`, and `async=1` to \
+    answer with the job id right away, its "done" event then holds the urls.
+    """
+    if not os.path.exists(os.path.join(IMAGE_DIR, img)):
+        return JSONResponse({"error": "The image file cannot be found."}, status_code=404)
 
-@app.get("/decode/{img}", response_class=HTMLResponse)
+    services = _services(request)
+    form = await request.form()
+    try:
+        intensities = ([float(value) for value in form.get("intensities").split(",")]
+                       if form.get("intensities") else list(_SWEEP))
+        seed = int(form.get("seed")) if form.get("seed") else None
+        assert 0 < len(intensities) <= _MAX_SWEEP, f"Between 1 and {_MAX_SWEEP} intensities."
+        assert all(0 <= intensity <= 1 for intensity in intensities), "Invalid intensity"
+    except (ValueError, AssertionError) as err:
+        return JSONResponse({"error": str(err)}, status_code=400)
+
+    outputs = [f"{uuid.uuid4().hex}.png" for _ in intensities]
+    input_path = os.path.join(IMAGE_DIR, img)
+    args = (preview_many_job, input_path, intensities,
+            [os.path.join(IMAGE_DIR, output) for output in outputs], seed,
+            services.settings.codec_profile)
+    cost = await _cost("preview_sweep", img, max(intensities), len(intensities))
+    try:
+        if form.get("async") == "1":
+            uid = await _start_job(services, img, outputs[0], None, *args, cost=cost,
+                                   client=_client(request), source=input_path,
+                                   extra_outputs=tuple(outputs[1:]))
+            return JSONResponse({"job": uid, "events": f"/jobs/{uid}/events"}, status_code=202)
+        uid = await _create_job(services, img, *outputs)
+        succeeded = await _run_job(services, uid, outputs[0], None, *args, cost=cost,
+                                   client=_client(request), source=input_path)
+    except QueueFullError:
+        return JSONResponse({"error": "The server is busy right now."}, status_code=503,
+                            headers={"Retry-After": str(services.settings.retry_after)})
+    except asyncio.exceptions.CancelledError:
+        return JSONResponse({"job": uid, "error": "Cancelled."}, status_code=409)
+    if not succeeded:
+        return JSONResponse({"job": uid, "error": "Cannot create the previews."}, status_code=500)
+    return {"job": uid, "intensities": intensities,
+            "urls": [f"/static/images/{output}" for output in outputs]}
+
+@router.get("/decode/{img}", response_class=HTMLResponse)
 async def start_decode(request: Request, img: str):
     """Start the decode html."""
     if not os.path.exists(os.path.join(IMAGE_DIR, img)):
@@ -203,7 +554,7 @@ async def start_decode(request: Request, img: str):
                 "If it continues to happen, install the local version.")})
     return templates.TemplateResponse("decode.html", {"request": request})
 
-@app.post("/decode/{img}", response_class=HTMLResponse)
+@router.post("/decode/{img}", response_class=HTMLResponse)
 async def end_decode(request: Request, img: str):
     """And this guys serve it with fire."""
     if not os.path.exists(os.path.join(IMAGE_DIR, img)):
@@ -211,36 +562,29 @@ async def end_decode(request: Request, img: str):
                 "The image file cannot be found, please restart the system. "
                 "If it continues to happen, install the local version.")})
 
+    services = _services(request)
     payload = await request.json()
     input_path = os.path.join(IMAGE_DIR, img)
     output_path = os.path.join(IMAGE_DIR, payload.get("save_path"))
 
-    json_path = os.path.join(IMAGE_DIR, f"{os.path.splitext(img)[0]}.json")
-
     if not payload.get("save_path"):
         return templates.TemplateResponse("decode.html",
                         {"request": request, "filename": img, "error": "Unable to load payload."})
-
-
-    uid: str = uuid.uuid4().hex
-    future_item = asyncio.get_event_loop().run_in_executor(executor, Steganography.decode,
-        Image.open(input_path), output_path)
-    future_item.add_done_callback(lambda _: _remove_from_list(uid))
-    background_task.update({uid: future_item})
-
-    with open(json_path, "wt", encoding="utf-8") as f:
-        json.dump({"uid": uid}, f)
-        f.close()
+    if await _probe(img) is None:
+        return templates.TemplateResponse("decode.html",
+                                          {"request": request, "error": _NOTHING_HIDDEN})
 
     try:
-        if await future_item:
+        uid = await _create_job(services, img, payload.get("save_path"))
+        if await _run_job(services, uid, payload.get("save_path"), None, decode_job,
+                          input_path, output_path, services.settings.codec_profile,
+                          cost=await _cost("decode", img), client=_client(request)):
             os.remove(input_path)
-            with open(json_path, "wt", encoding="utf-8") as f:
-                json.dump({"filename": payload.get("save_path")}, f)
-                f.close()
             return templates.TemplateResponse("decode.html",
                                         {"request": request, "filename": payload.get("save_path")})
         os.remove(input_path)
+    except QueueFullError:
+        return _busy("decode.html", {"request": request})
     except asyncio.exceptions.CancelledError:
         return templates.TemplateResponse("encode.html",
                 {"request": request, "filename": img, "error": "User exited."})
@@ -249,27 +593,86 @@ async def end_decode(request: Request, img: str):
         "email me or create a Github issue and I will see what can be assisted."
     )})
 
-@app.post("/remove/{img}")
-async def remove(img: str):
+@router.post("/remove/{img}")
+async def remove(request: Request, img: str):
     """Remove file when user exit."""
-    scr_path = os.path.join(IMAGE_DIR, img)
-    if os.path.exists(scr_path):
-        os.remove(scr_path)
-
-    json_path = os.path.join(IMAGE_DIR, f"{os.path.splitext(img)[0]}.json")
-    if not os.path.exists(json_path):
-        return
-    with open(json_path, "rt", encoding="utf-8") as f:
-        json_data: dict = json.load(f)
-        f.close()
-    if os.path.exists(json_path):
-        os.remove(json_path)
-
-    try:
-        background_task.get(json_data.pop("uid_", json_data.pop("uid"))).cancel()
-    except AttributeError:
-        pass
-    for path in json_data.values():
-        img_path = os.path.join(IMAGE_DIR, path)
-        if os.path.exists(img_path):
-            os.remove(img_path)
+    services = _services(request)
+    _remove_files(img)
+
+    # jobs running on other workers are cancelled by their own `cancel_worker`.
+    cancelling = await asyncio.to_thread(services.registry.request_cancel, img)
+    for uid in cancelling:
+        services.executor.cancel(uid)
+
+    jobs = await asyncio.to_thread(services.registry.of_owner, img)
+    for job in jobs:
+        _remove_files(*job.outputs)
+    await asyncio.to_thread(services.registry.delete,
+                            [job.uid for job in jobs if job.uid not in cancelling])
+
+@router.get("/probe/{img}")
+async def probe(img: str):
+    """
+    Whether something is hidden within the upload `img`, with its codec, length and format, \
+    read from the first bytes of embedded data only.
+    """
+    if not os.path.exists(os.path.join(IMAGE_DIR, img)):
+        return JSONResponse({"image": img, "encoded": False}, status_code=404)
+    payload = await _probe(img)
+    if payload is None:
+        return {"image": img, "encoded": False}
+    return {"image": img, "encoded": True} | asdict(payload)
+
+@router.get("/jobs/{uid}")
+async def job_state(request: Request, uid: str):
+    """Status and progress of the job `uid`, with the url of its result once done."""
+    job = await asyncio.to_thread(_services(request).registry.get, uid)
+    if job is None:
+        return JSONResponse({"job": uid, "status": "unknown"}, status_code=404)
+    return _job_state(job)
+
+@router.get("/jobs/{uid}/events")
+async def job_events(request: Request, uid: str):
+    """
+    Server-Sent Events of the job `uid`: "progress" while it runs, then one of "done", \
+    "failed" or "cancelled". Read from the registry, so any worker can serve them.
+    """
+    registry = _services(request).registry
+
+    async def events():
+        last, quiet = None, 0.0
+        while not await request.is_disconnected():
+            job = await asyncio.to_thread(registry.get, uid)
+            if job is None:
+                yield f"event: failed\ndata: {json.dumps({'job': uid, 'status': 'unknown'})}\n\n"
+                return
+            state = _job_state(job)
+            if job.status in FINISHED:
+                yield f"event: {job.status}\ndata: {json.dumps(state)}\n\n"
+                return
+            if state != last:
+                last, quiet = state, 0.0
+                yield f"event: progress\ndata: {json.dumps(state)}\n\n"
+            elif quiet >= 15: # a comment now and then, so proxies keep the connection.
+                quiet = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(0.25)
+            quiet += 0.25
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/jobs/{uid}/cancel")
+async def cancel_job(request: Request, uid: str):
+    """Cancel the job `uid`, wherever it runs."""
+    services = _services(request)
+    # a job running on another worker is cancelled by that worker's `cancel_worker`.
+    cancelled = await asyncio.to_thread(services.registry.request_cancel_job, uid)
+    if cancelled:
+        services.executor.cancel(uid)
+    return {"job": uid, "cancelled": cancelled}
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Metrics of this worker, in the Prometheus text format."""
+    return PlainTextResponse(METRICS.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,35 @@
+"""
+Animated previews through the process executor, frames spread over a pool within a job worker.
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+from src.jobs import ProcessJobExecutor, preview_job
+
+def _animation(path: str, durations: list[int]):
+    rng = np.random.default_rng(0)
+    frames = [Image.fromarray(rng.integers(0, 256, (48, 64, 3), np.uint8)) for _ in durations]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=durations, loop=0)
+
+@pytest.mark.parametrize("name", ["animation.gif", "animation.png"])
+def test_animated_preview_on_process_executor(tmp_path, name):
+    source, output = str(tmp_path / name), str(tmp_path / "preview.png")
+    durations = [40, 80, 120]
+    _animation(source, durations)
+
+    async def run():
+        executor = ProcessJobExecutor(1)
+        try:
+            return await executor.run("job", preview_job, source, 0.5, output, 0, "fast", 2)
+        finally:
+            executor.shutdown()
+
+    assert asyncio.run(run())
+    with Image.open(output) as preview:
+        assert preview.n_frames == len(durations)
+        frames = ImageSequence.Iterator(preview)
+        assert [round(frame.info["duration"]) for frame in frames] == durations